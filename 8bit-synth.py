@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import math
 import signal
 import time
 from sys import exit
@@ -17,6 +16,8 @@ except ImportError:
 
 import pianohat
 
+import synth
+
 
 print("""
 8-bit Piano HAT
@@ -35,8 +36,8 @@ Please wait while Pygame is set up and samples are generated...
 Press CTRL+C to exit!
 """)
 
-BITRATE = 8
-SAMPLERATE = 44100
+BITRATE = synth.BITRATE
+SAMPLERATE = synth.SAMPLERATE
 
 ATTACK_MS=25
 RELEASE_MS=500
@@ -49,10 +50,6 @@ enabled = {'sine':True, 'saw':False, 'square':False}
 notes = {'sine':[],'saw':[],'square':[]}
 
 
-# The samples are 8bit signed, from -127 to +127
-# so the max amplitude of a sample is 127
-max_sample = 2**(BITRATE - 1) - 1
-
 def handle_instrument(channel, pressed):
     """Handles the Instrument, Octave Up/Down keys
     These toggle Sine, Saw and Square waves on and off so you can combine them
@@ -90,23 +87,6 @@ def play_sample(channel, pressed):
             notes[t][channel].fadeout(RELEASE_MS)
 
 
-def wave_sine(freq, time):
-    """Generates a single sine wave sample"""
-    s = math.sin(2*math.pi*freq*time)
-    return int(round(max_sample * s ))
-
-
-def wave_square(freq, time):
-    """Generates a single square wave sample"""
-    return -max_sample if freq*time < 0.5 else max_sample
-
-
-def wave_saw(freq, time):
-    """Generates a single sav wave sample"""
-    s = ((freq*time)*2) - 1
-    return int(round(max_sample * s)) 
-
-
 def update_leds():
     """Updates the Instrument and Octave LEDs to show enabled samples"""
     pianohat.set_led(15, enabled['sine'])
@@ -114,21 +94,9 @@ def update_leds():
     pianohat.set_led(13, enabled['square'])
 
 
-def generate_sample(frequency, volume=1.0, wavetype=None):
-    """Generates a sample of a specific frequency and wavetype"""
-    if wavetype is None:
-        wavetype = wave_square
-
-    sample_count = int(round(SAMPLERATE/frequency))
-
-    buf = numpy.zeros((sample_count, 2), dtype = numpy.int8)
-
-    for s in range(sample_count):
-        t = float(s)/SAMPLERATE # Time index
-        buf[s][0] = wavetype(frequency, t)
-        buf[s][1] = buf[s][0] # Copy to stero channel
-
-    sound = pygame.sndarray.make_sound(buf)
+def generate_sample(frequency, volume=1.0, wavetype='square'):
+    """Generates a band-limited loop of a specific frequency and wavetype"""
+    sound = pygame.sndarray.make_sound(synth.render_wavetable(frequency, wavetype))
     sound.set_volume(volume) # Set the volume to balance sounds
 
     return sound
@@ -156,9 +124,9 @@ for f in [
         493.883,
         523.251
     ]:
-    notes['sine'] += [generate_sample(f, volume=volume['sine'], wavetype=wave_sine)]
-    notes['saw'] += [generate_sample(f, volume=volume['saw'], wavetype=wave_saw)]
-    notes['square'] += [generate_sample(f, volume=volume['square'], wavetype=wave_square)]
+    notes['sine'] += [generate_sample(f, volume=volume['sine'], wavetype='sine')]
+    notes['saw'] += [generate_sample(f, volume=volume['saw'], wavetype='saw')]
+    notes['square'] += [generate_sample(f, volume=volume['square'], wavetype='square')]
 
 
 pianohat.auto_leds(False)
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+import numpy
+import pygame
+
+import dispatch
+import engine
+import hardware
+import instruments
+import looper
+import synth
+import voices
+
+DESCRIPTION = '''Microbenchmarks for RPi-Band. Runs headless, no HATs required.'''
+
+PERCENTILES = [50, 95, 99]
+
+############## reference: the original per-sample loop
+def loop_sine(freq, time):
+    s = math.sin(2*math.pi*freq*time)
+    return int(round(synth.max_sample * s))
+
+
+def loop_square(freq, time):
+    return -synth.max_sample if freq*time < 0.5 else synth.max_sample
+
+
+def loop_saw(freq, time):
+    s = ((freq*time)*2) - 1
+    return int(round(synth.max_sample * s))
+
+
+def loop_generate_buffer(frequency, wavetype):
+    sample_count = int(round(synth.SAMPLERATE/frequency))
+
+    buf = numpy.zeros((sample_count, 2), dtype = numpy.int8)
+
+    for s in range(sample_count):
+        t = float(s)/synth.SAMPLERATE
+        buf[s][0] = wavetype(frequency, t)
+        buf[s][1] = buf[s][0]
+
+    return buf
+
+############## /reference
+
+
+def best_of(function, repeat):
+    """ Returns the fastest of repeat runs of function in seconds. """
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def bench_wavetable(args):
+    """ Compares the vectorized waveform engine against the per-sample loop
+    for all notes and wave types of the synthesizer. """
+
+    pairs = [(loop_sine, synth.wave_sine), (loop_saw, synth.wave_saw),
+             (loop_square, synth.wave_square)]
+
+    for loop_wave, vector_wave in pairs:
+        for f in synth.FREQUENCIES:
+            if not numpy.array_equal(loop_generate_buffer(f, loop_wave),
+                                     synth.generate_buffer(f, vector_wave)):
+                sys.exit('{} differs from the reference at {} Hz'.format(
+                    vector_wave.__name__, f))
+
+    def run_loop():
+        for loop_wave, _ in pairs:
+            for f in synth.FREQUENCIES:
+                loop_generate_buffer(f, loop_wave)
+
+    def run_vector():
+        for _, vector_wave in pairs:
+            for f in synth.FREQUENCIES:
+                synth.generate_buffer(f, vector_wave)
+
+    loop_time = best_of(run_loop, args.repeat)
+    vector_time = best_of(run_vector, args.repeat)
+
+    print('output identical for {} buffers'.format(len(pairs) * len(synth.FREQUENCIES)))
+    print('per-sample loop: {:8.2f} ms'.format(loop_time * 1000))
+    print('vectorized:      {:8.2f} ms'.format(vector_time * 1000))
+    print('speedup:         {:8.1f}x'.format(loop_time / vector_time))
+
+
+def bench_pitch(args):
+    """ Compares the pitch of single period loops with the multi-period
+    band-limited loops and times rendering the band-limited banks. """
+
+    print('  freq Hz  single period cents  band-limited cents  periods')
+    for octave in range(-2, 4):
+        f = synth.FREQUENCIES[9] * 2**octave  # the A of every octave
+        single = round(synth.SAMPLERATE / f)
+        periods, length = synth.loop_periods(f)
+        print('{:9.2f} {:20.2f} {:19.2f} {:8d}'.format(
+            f, 1200 * math.log2(synth.SAMPLERATE / single / f),
+            1200 * math.log2(periods * synth.SAMPLERATE / length / f), periods))
+
+    def run():
+        synth._tables.clear()
+        for wavetype in synth.WAVETYPES:
+            synth.generate_bank(synth.FREQUENCIES, wavetype)
+
+    print('rendering all banks: {:.2f} ms'.format(1000 * best_of(run, args.repeat)))
+
+
+def bench_mixer(args):
+    """ Mixes looped synth voices with the numpy engine into a null sink
+    and reports how much faster than real time that runs. """
+
+    budgets = {'drums': args.voices // 2, 'piano': args.voices - args.voices // 2}
+    mixer = engine.SoftwareMixer(budgets, engine.NullSink(), synth.SAMPLERATE,
+                                 args.block_size)
+
+    for i in range(args.voices):
+        f = synth.FREQUENCIES[i % len(synth.FREQUENCIES)]
+        buf = synth.to_mixer_format(synth.generate_buffer(f, synth.wave_saw))
+        mixer.play('drums' if i % 2 else 'piano', buf, loops=-1)
+
+    blocks = int(args.seconds * synth.SAMPLERATE / args.block_size)
+
+    def run():
+        for _ in range(blocks):
+            mixer.sink.write(mixer.render_block())
+
+    elapsed = best_of(run, args.repeat)
+
+    print('{} voices, {} sample blocks'.format(args.voices, args.block_size))
+    print('per block:       {:8.3f} ms (budget {:.3f} ms)'.format(
+        1000 * elapsed / blocks, 1000.0 * args.block_size / synth.SAMPLERATE))
+    print('real time:       {:8.1f}x'.format(args.seconds / elapsed))
+
+
+def bench_cache(args):
+    """ Plays keys in turns on a synth note cache that holds only some of
+    them, coming back to a few frequent keys after every other key. Checks
+    that the frequent keys are never rebuilt and times hits and builds. """
+
+    frequencies = synth.note_frequencies(*instruments.SYNTH_RANGE)
+    combination = ('saw',)
+
+    def make_sound(buffers, names):
+        return synth.mixdown(buffers, [1.0] * len(buffers))
+
+    def new_bank(max_bytes):
+        bank = synth.LazyBank(make_sound, frequencies, max_bytes=max_bytes,
+                              sound_bytes=lambda sound: sound.nbytes)
+        bank.load_banks(combination)
+        return bank
+
+    keys = range(len(frequencies))
+    sizes = new_bank(float('inf'))
+    largest = max(sizes.get(combination, key).nbytes for key in keys)
+    bank = new_bank(args.capacity * largest)
+
+    frequent = list(keys[:args.frequent])
+    hits, builds, built, rebuilt = [], [], set(), 0
+    for _ in range(args.rounds):
+        for key in keys[args.frequent:]:
+            for played in [key] + frequent:
+                cached = bank.get(combination, played, create=False) is not None
+                start = time.perf_counter()
+                bank.get(combination, played)
+                (hits if cached else builds).append(time.perf_counter() - start)
+                if not cached and played in frequent and played in built:
+                    rebuilt += 1
+                built.add(played)
+
+    print('{} of {} keys fit, {} frequent, {} rounds'.format(
+        args.capacity, len(frequencies), args.frequent, args.rounds))
+    print('hits:   {:6d}, {:.3f} ms on average'.format(len(hits), 1000 * numpy.mean(hits)))
+    print('builds: {:6d}, {:.3f} ms on average'.format(len(builds), 1000 * numpy.mean(builds)))
+    if rebuilt:
+        sys.exit('the frequent keys were evicted and rebuilt {} times'.format(rebuilt))
+    print('the frequent keys stayed cached')
+
+
+class CountingChannel:
+    """ A mixer channel that records the sounds started on it and their
+    loops. """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.started = []
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def play(self, sound, loops=0, **kwargs):
+        self.started.append((sound, loops))
+        self.channel.play(sound, loops=loops, **kwargs)
+
+
+def bench_steal(args):
+    """ Steals the only voice of a pool for looped sounds, again before
+    the start of the last one is due, and checks that only the sound of
+    the latest steal starts after the fade. """
+
+    # keep pygame away from the audio device
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.mixer.pre_init(synth.SAMPLERATE, -16, 1, instruments.BUFFER_SIZE)
+    pygame.mixer.init()
+    pygame.mixer.set_num_channels(1)
+
+    allocator = voices.VoiceAllocator({'piano': 1})
+    pool = allocator.pools['piano']
+    channel = pool.channels[0] = CountingChannel(pool.channels[0])
+
+    wave = synth.to_mixer_format(synth.generate_buffer(synth.FREQUENCIES[0], synth.wave_saw))
+    held = pygame.sndarray.make_sound(numpy.tile(wave, 1000))
+    loop = pygame.sndarray.make_sound(wave)
+    other = pygame.sndarray.make_sound(wave.copy())
+    names = {loop: 'loop', other: 'other', held: 'held'}
+
+    def steal(steals):
+        """Returns the sounds started after stealing the playing voice for
+        each (sound, loops) of steals in turn"""
+
+        allocator.stop_all()
+        allocator.play('piano', held)
+        channel.started = []
+        for sound, loops in steals:
+            # the start of the last steal is late, the fade is over
+            pool.fading[0] = 0.0
+            allocator.play('piano', sound, loops=loops)
+        time.sleep(args.wait_ms / 1000.0)
+        return ['{} x{}'.format(names[sound], loops) for sound, loops in channel.started]
+
+    # the same sound is looped a different number of times by each steal
+    cases = [('looped', [(loop, -1)], ['loop x-1']),
+             ('twice, same sound', [(loop, -1), (loop, 3)], ['loop x3']),
+             ('twice, other sound', [(loop, -1), (other, -1)], ['other x-1']),
+             ('then queued', [(loop, -1), (other, 0)], [])]
+
+    failed = 0
+    for name, steals, expected in cases:
+        started = steal(steals)
+        print('{:20} started {}'.format(name, ', '.join(started) or 'nothing'))
+        if started != expected:
+            print('{:20} expected {}'.format('', ', '.join(expected) or 'nothing'))
+            failed += 1
+
+    allocator.stop_all()
+    pygame.mixer.quit()
+    if failed:
+        sys.exit('{} of {} steals started the wrong sounds'.format(failed, len(cases)))
+
+
+############## event streams for the handler suite
+def drum_roll(duration, rate=30.0):
+    """Alternating hits on two pads"""
+
+    return [hardware.Event(i / rate, 'hit', i % 2, True)
+            for i in range(int(duration * rate))]
+
+
+def chords(duration, size=6, length=0.5):
+    """Chords of size keys, pressed and released every length seconds"""
+
+    events = []
+    for i in range(int(duration / length)):
+        root = i % (hardware.PIANO_KEYS - size)
+        for key in range(root, root + size):
+            events.append(hardware.Event(i * length, 'note', key, True))
+            events.append(hardware.Event((i + 0.9) * length, 'note', key, False))
+
+    return sorted(events, key=lambda event: event.time)
+
+
+def glissando(duration, rate=40.0):
+    """All keys up and down again, every key released after the next one"""
+
+    keys = list(range(hardware.PIANO_KEYS)) + list(range(hardware.PIANO_KEYS - 2, 0, -1))
+    events = []
+    for i in range(int(duration * rate)):
+        key = keys[i % len(keys)]
+        events.append(hardware.Event(i / rate, 'note', key, True))
+        events.append(hardware.Event((i + 1) / rate, 'note', key, False))
+
+    return sorted(events, key=lambda event: event.time)
+
+
+def switching(duration, interval=0.5):
+    """The instrument button under a drum roll and a glissando"""
+
+    events = drum_roll(duration) + glissando(duration, rate=10.0)
+    events += [hardware.Event(i * interval, 'instrument', 0, True)
+               for i in range(1, int(duration / interval))]
+
+    return sorted(events, key=lambda event: event.time)
+
+
+SCENARIOS = {
+    'drum_roll': drum_roll,
+    'chords': chords,
+    'glissando': glissando,
+    'switching': switching,
+}
+
+############## /event streams
+
+
+def chained_sleeps(steps, interval):
+    """Returns how far a loop that sleeps interval per step has drifted from
+    the time it should end at"""
+
+    start = time.monotonic()
+    for _ in range(steps):
+        time.sleep(interval)
+        # the work of a step, e.g. playing a sound
+        time.perf_counter()
+
+    return time.monotonic() - (start + steps * interval)
+
+
+def bench_looper(args):
+    """ Plays many overlapping loops of random sixteenth notes and reports
+    how late the scheduler ran them, its CPU use and, for comparison, how
+    far chained sleeps drift in the same time. """
+
+    instruments.init_mixer(backend='numpy', sink='null')
+    hat = dispatch.DispatchBackend(hardware.SimulatedBackend())
+    container = instruments.Container(instruments.sound_sets.index(args.piano),
+                                      instruments.sound_sets.index(args.drums), hat)
+    hat.start()
+
+    loops = looper.Looper(args.tempo, layers=args.patterns)
+    steps = looper.BEATS_PER_BAR * 4
+    step = loops.length / steps
+    start = time.monotonic() + 0.5
+
+    rng = numpy.random.default_rng(0)
+    for _ in range(args.patterns):
+        pattern = looper.Pattern(start, loops.length)
+        for i in numpy.flatnonzero(rng.random(steps) < args.density):
+            pattern.events.append((i * step, ('hit', int(rng.integers(hardware.DRUM_PADS)),
+                                              True, int(rng.integers(1, 128)))))
+        loops.add(pattern)
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    loops.start(hat)
+    time.sleep(args.seconds)
+    loops.stop()
+    hat.stop()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    instruments.allocator.stop()
+
+    lateness = numpy.array(loops.events.lateness) * 1000
+    print('{} patterns at {:.0f} bpm, {} events in {:.0f} s'.format(
+        args.patterns, args.tempo, loops.lateness.count, args.seconds))
+    print('lateness ms:  {}, max {:.3f}'.format(
+        ', '.join('p{} {:.3f}'.format(p, numpy.percentile(lateness, p)) for p in PERCENTILES),
+        lateness.max()))
+    print('dispatch:     {} events, {} dropped'.format(hat.counters['dispatched'],
+                                                      hat.counters['overflow']))
+    print('cpu:          {:8.1f}%'.format(100.0 * cpu / wall))
+
+    drift = chained_sleeps(int(args.seconds / step), step)
+    print('chained time.sleep drifts {:.1f} ms in {:.0f} s'.format(1000 * drift, args.seconds))
+
+
+def run_scenario(name, args):
+    """ Replays a scenario on fresh instruments and returns its results. """
+
+    hat = hardware.SimulatedBackend()
+    container = instruments.Container(instruments.sound_sets.index(args.piano),
+                                      instruments.sound_sets.index(args.drums), hat)
+    script = SCENARIOS[name](args.seconds)
+
+    counters = dict(instruments.allocator.counters)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    hat.replay(script, args.speed)
+
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    # silence everything, so the next scenario starts with free voices
+    instruments.allocator.stop_all()
+
+    result = {'events': hat.events,
+              'events_per_second': hat.events / wall,
+              'cpu_percent': 100.0 * cpu / wall}
+    for p in PERCENTILES:
+        result['callback_p{}_ms'.format(p)] = 1000 * float(numpy.percentile(hat.callback_times, p))
+    for key in ('played', 'stolen', 'dropped'):
+        result[key] = instruments.allocator.counters[key] - counters[key]
+
+    return result
+
+
+def bench_handlers(args):
+    """ Drives the instrument handlers with synthetic event streams and
+    reports callback latency percentiles, voice counters and CPU use. """
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    instruments.init_mixer(backend=args.backend, sink='null')
+
+    results = {'platform': platform.platform(),
+               'python': platform.python_version(),
+               'backend': args.backend,
+               'speed': args.speed,
+               'scenarios': {}}
+
+    print('{:10} {:>7} {:>8} {:>8} {:>8} {:>7} {:>7} {:>6}'.format(
+        'scenario', 'events', 'p50 ms', 'p95 ms', 'p99 ms', 'stolen', 'dropped', 'cpu %'))
+    for name in args.scenarios or SCENARIOS:
+        result = run_scenario(name, args)
+        results['scenarios'][name] = result
+        print('{:10} {:7d} {:8.3f} {:8.3f} {:8.3f} {:7d} {:7d} {:6.1f}'.format(
+            name, result['events'], result['callback_p50_ms'], result['callback_p95_ms'],
+            result['callback_p99_ms'], result['stolen'], result['dropped'],
+            result['cpu_percent']))
+
+    if args.backend == 'numpy':
+        instruments.allocator.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+def compare(path, results):
+    """Prints how the latency percentiles changed against an older run"""
+
+    with open(path) as f:
+        old = json.load(f)
+
+    print('\nchange against {}'.format(path))
+    for name, result in results['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if before is None:
+            continue
+        changes = ['p{} {:+.1f}%'.format(p, 100.0 * (result[key] / before[key] - 1)
+                                         if before[key] else 0.0)
+                   for p, key in ((p, 'callback_p{}_ms'.format(p)) for p in PERCENTILES)]
+        print('{:10} {}'.format(name, ', '.join(changes)))
+
+
+def parse_arguments(sysargs):
+    """ Setup the command line options. """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    wavetable = subparsers.add_parser('wavetable',
+        help='vectorized synth generation vs. the per-sample loop')
+    wavetable.set_defaults(function=bench_wavetable)
+
+    pitch = subparsers.add_parser('pitch',
+        help='pitch error of single period vs. band-limited multi-period loops')
+    pitch.set_defaults(function=bench_pitch)
+
+    cache = subparsers.add_parser('cache',
+        help='least recently used eviction of the synth note cache')
+    cache.add_argument('--capacity', type=int, default=8,
+                       help='notes of the largest size that fit')
+    cache.add_argument('--frequent', type=int, default=3)
+    cache.add_argument('--rounds', type=int, default=3)
+    cache.set_defaults(function=bench_cache)
+
+    steal = subparsers.add_parser('steal',
+        help='looped sounds started on a stolen pygame voice')
+    steal.add_argument('--wait-ms', type=float, default=10 * voices.STEAL_FADE_MS,
+                       help='time given the starts after the fade')
+    steal.set_defaults(function=bench_steal)
+
+    mixer = subparsers.add_parser('mixer', help='numpy mixing engine into a null sink')
+    mixer.add_argument('--voices', type=int, default=32)
+    mixer.add_argument('--block-size', type=int, default=engine.BLOCK_SIZE)
+    mixer.add_argument('--seconds', type=float, default=5.0)
+    mixer.set_defaults(function=bench_mixer)
+
+    looping = subparsers.add_parser('looper',
+        help='timing jitter of many overlapping loops')
+    looping.add_argument('-p', '--piano', default='piano')
+    looping.add_argument('-d', '--drums', default='drums2')
+    looping.add_argument('--patterns', type=int, default=32)
+    looping.add_argument('--tempo', type=float, default=120.0)
+    looping.add_argument('--density', type=float, default=0.25,
+                         help='share of the sixteenth notes of a pattern that are hit')
+    looping.add_argument('--seconds', type=float, default=10.0)
+    looping.set_defaults(function=bench_looper)
+
+    handlers = subparsers.add_parser('handlers',
+        help='event-to-sound latency and throughput of the instrument handlers')
+    handlers.add_argument('scenarios', nargs='*',
+                          help='{} (default: all)'.format(', '.join(SCENARIOS)))
+    handlers.add_argument('-p', '--piano', default='piano')
+    handlers.add_argument('-d', '--drums', default='drums2')
+    handlers.add_argument('--backend', choices=['pygame', 'numpy'], default='numpy')
+    handlers.add_argument('--seconds', type=float, default=3.0,
+                          help='length of every scenario')
+    handlers.add_argument('--speed', type=float, default=1.0,
+                          help='replay speed, 0 for as fast as possible')
+    handlers.add_argument('-o', '--output', help='write the results as JSON')
+    handlers.add_argument('--compare', help='JSON results of an older run')
+    handlers.set_defaults(function=bench_handlers)
+
+    return parser.parse_args(sysargs)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+    args.function(args)
@@ -0,0 +1,177 @@
+""" The touch callbacks of the HAT libraries only put a small tuple into a
+bounded queue; one dispatch thread calls the instrument handlers, drums
+first. A sound set the next instrument needs is decoded on a loader
+thread of its own and the switch itself is then queued for the dispatch
+thread, so it never runs at the same time as a note handler. A slow
+handler can't stall the polling of the HATs, and loading never holds up
+a note. """
+
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+import traceback
+
+import hardware
+import stats
+
+# lower goes first; events of the same priority keep their order, so all
+# Piano HAT events share one and a key after an octave button plays in the
+# new octave; 'loaded' finishes a defer() once its loading is done
+PRIORITIES = {'hit': 0, 'release': 0, 'note': 1, 'octave_up': 1, 'octave_down': 1,
+              'instrument': 1, 'loaded': 1}
+
+# events waiting for the dispatch thread; more are dropped and counted
+QUEUE_SIZE = 256
+
+# seconds stop() and a finished load wait for room in a full queue
+STOP_TIMEOUT_S = 1.0
+
+
+class DispatchBackend:
+    """ Wraps an input backend; the instruments register their handlers
+    here and the dispatch thread calls them. """
+
+    def __init__(self, backend, size=QUEUE_SIZE):
+        self.backend = backend
+        self.handlers = {}
+        # (priority, sequence number, queued at, kind, channel, pressed, velocity)
+        self.queue = queue.PriorityQueue(size)
+        self.counter = itertools.count()
+        self.loader = concurrent.futures.ThreadPoolExecutor(1)
+        self.thread = None
+
+        self.counters = {'dispatched': 0, 'loads': 0, 'overflow': 0, 'errors': 0,
+                         'max_depth': 0}
+        # seconds from the callback until the dispatch thread took the event,
+        # and the seconds the handlers and the loads of defer() took
+        self.waited = stats.Histogram()
+        self.handled = stats.Histogram()
+        self.loaded = stats.Histogram()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def put(self, kind, channel, pressed, velocity):
+        entry = (PRIORITIES[kind], next(self.counter), time.perf_counter(),
+                 kind, channel, pressed, velocity)
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.counters['overflow'] += 1
+
+    def register(self, kind, handler):
+        """Returns the callback for the backend, which only queues"""
+
+        self.handlers[kind] = handler
+        if kind in ('hit', 'release'):
+            def queued(event):
+                self.put(kind, event.channel, True,
+                         getattr(event, 'velocity', hardware.MAX_VELOCITY))
+        else:
+            def queued(channel, pressed):
+                self.put(kind, channel, pressed, hardware.MAX_VELOCITY)
+        return queued
+
+    def on_hit(self, handler):
+        self.backend.on_hit(self.register('hit', handler))
+
+    def on_release(self, handler):
+        self.backend.on_release(self.register('release', handler))
+
+    def on_note(self, handler):
+        self.backend.on_note(self.register('note', handler))
+
+    def on_octave_up(self, handler):
+        self.backend.on_octave_up(self.register('octave_up', handler))
+
+    def on_octave_down(self, handler):
+        self.backend.on_octave_down(self.register('octave_down', handler))
+
+    def on_instrument(self, handler):
+        self.backend.on_instrument(self.register('instrument', handler))
+
+    def defer(self, prepare, then):
+        """Calls prepare, which loads, on the loader thread and then queues
+        then, which uses what it loaded, for the dispatch thread"""
+
+        def load():
+            start = time.perf_counter()
+            try:
+                prepare()
+            except Exception:
+                self.counters['errors'] += 1
+                print('loading failed:')
+                traceback.print_exc()
+                return
+            finally:
+                self.loaded.add(time.perf_counter() - start)
+
+            # waits for room, a dropped switch would be lost for good
+            entry = (PRIORITIES['loaded'], next(self.counter), time.perf_counter(),
+                     'loaded', then, True, hardware.MAX_VELOCITY)
+            try:
+                self.queue.put(entry, timeout=STOP_TIMEOUT_S)
+            except queue.Full:
+                self.counters['overflow'] += 1
+
+        self.counters['loads'] += 1
+        self.loader.submit(load)
+
+    def call(self, kind, channel, pressed, velocity):
+        """Calls the handler of an event; an error is printed and counted,
+        so one broken handler doesn't stop the events after it"""
+
+        start = time.perf_counter()
+        try:
+            if kind == 'loaded':
+                # the channel of a finished load is the function to call
+                channel()
+            elif kind in ('hit', 'release'):
+                # looked up now, a new piano registers its handlers once it loaded
+                self.handlers[kind](hardware.DrumEvent(channel, velocity))
+            else:
+                self.handlers[kind](channel, pressed)
+        except Exception:
+            self.counters['errors'] += 1
+            print('{} {} failed:'.format(kind, channel))
+            traceback.print_exc()
+
+        self.handled.add(time.perf_counter() - start)
+
+    def run(self):
+        """Calls the handlers of the queued events until stop()"""
+
+        while True:
+            self.counters['max_depth'] = max(self.counters['max_depth'], self.queue.qsize())
+            _, _, queued, kind, channel, pressed, velocity = self.queue.get()
+            if kind is None:
+                return
+
+            self.waited.add(time.perf_counter() - queued)
+            self.counters['dispatched'] += 1
+            self.call(kind, channel, pressed, velocity)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Handles the queued events, then ends the threads"""
+
+        if self.thread is not None and self.thread.is_alive():
+            # after everything else; put waits for room rather than dropping it
+            try:
+                last = max(PRIORITIES.values()) + 1
+                self.queue.put((last, next(self.counter), 0.0, None, 0, False, 0),
+                               timeout=STOP_TIMEOUT_S)
+                self.thread.join()
+            except queue.Full:
+                pass
+        self.thread = None
+        self.loader.shutdown()
+
+    def snapshot(self):
+        return dict(self.counters, depth=self.queue.qsize(), waited=self.waited.snapshot(),
+                    handled=self.handled.snapshot(), loaded=self.loaded.snapshot())
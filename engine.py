@@ -0,0 +1,360 @@
+""" Software mixing engine: a fixed pool of voices is summed with numpy into
+a preallocated block, which a dedicated thread pushes to a sink. It has the
+same play() interface as voices.VoiceAllocator and can replace pygame's
+mixer for playback; pygame is then only used for decoding the .wav files. """
+
+import subprocess
+import threading
+import time
+import wave
+import weakref
+
+import numpy
+import pygame
+
+from voices import STEAL_FADE_MS
+
+BLOCK_SIZE = 256
+
+
+class NullSink:
+    """ Drops every block, for benchmarking the mixing itself. """
+
+    def write(self, block):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """ Writes the blocks into a mono 16 bit .wav file. """
+
+    def __init__(self, path, samplerate):
+        self.file = wave.open(path, 'wb')
+        self.file.setnchannels(1)
+        self.file.setsampwidth(2)
+        self.file.setframerate(samplerate)
+
+    def write(self, block):
+        self.file.writeframesraw(block)
+
+    def close(self):
+        self.file.close()
+
+
+class AplaySink:
+    """ Pipes the blocks into ALSA's aplay; writes block while aplay's buffer
+    is full, which paces the mixing thread in real time. """
+
+    def __init__(self, samplerate, buffer_size):
+        self.process = subprocess.Popen(
+            ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1',
+             '-r', str(samplerate), '--buffer-size={}'.format(buffer_size)],
+            stdin=subprocess.PIPE)
+
+    def write(self, block):
+        self.process.stdin.write(block)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class Voice:
+    """ One slot of the voice pool, handed out by SoftwareMixer.play. Offers
+    the pygame.mixer.Channel methods the instruments use. """
+
+    def __init__(self, mixer):
+        self.mixer = mixer
+        self.sound = None
+        self.data = None
+        self.position = 0
+        self.loops = 0
+        self.gain = 0.0
+        self.gain_step = 0.0
+        self.gain_target = 0.0
+        # the gain a fade started at, its length and the samples done, so a
+        # fade ends on the same sample however the blocks are split
+        self.fade_from = 0.0
+        self.fade_length = 0
+        self.fade_done = 0
+        # the volume set on a pygame sound, e.g. to balance the synth waves
+        self.volume = 1.0
+        self.started = 0.0
+        self.length = 0.0
+        # (sound, data, loops, fade_ms) started when a stolen voice is silent
+        self.queued = None
+
+    def get_busy(self):
+        return self.sound is not None
+
+    def get_sound(self):
+        return self.sound
+
+    def get_queue(self):
+        return self.queued[0] if self.queued else None
+
+    def queue(self, sound):
+        """Plays sound after the current one, or right away if the voice is
+        idle; replaces a sound queued before"""
+
+        data = self.mixer.samples(sound)
+        with self.mixer.lock:
+            if self.sound is None:
+                self.start(sound, data)
+            else:
+                self.queued = (sound, data, 0, 0)
+
+    def fadeout(self, ms):
+        with self.mixer.lock:
+            if self.sound is not None:
+                self.fade_to(0.0, ms)
+
+    def stop(self):
+        with self.mixer.lock:
+            self.sound = self.data = self.queued = None
+
+    def start(self, sound, data, loops=0, fade_ms=0):
+        self.sound = sound
+        self.data = data
+        self.position = 0
+        self.loops = loops
+        self.queued = None
+        self.volume = 1.0 if isinstance(sound, numpy.ndarray) else sound.get_volume()
+        if fade_ms:
+            self.gain = 0.0
+            self.fade_to(1.0, fade_ms)
+        else:
+            self.gain = self.gain_target = 1.0
+            self.gain_step = 0.0
+
+    def fade_to(self, target, ms):
+        samples = max(1, int(self.mixer.samplerate * ms / 1000))
+        self.gain_target = target
+        self.gain_step = (target - self.gain) / samples
+        self.fade_from = self.gain
+        self.fade_length = samples
+        self.fade_done = 0
+
+
+class SoftwareMixer:
+    """ Splits a fixed pool of voices into budgets like
+    voices.VoiceAllocator and mixes them block by block. Everything the
+    mixing thread touches is allocated up front. """
+
+    def __init__(self, budgets, sink, samplerate=44100, block_size=BLOCK_SIZE,
+                 policy='quietest', realtime=False):
+        self.sink = sink
+        # sinks that don't block, like files, are paced by the mixing thread
+        self.realtime = realtime
+        self.samplerate = samplerate
+        self.block_size = block_size
+        self.policy = policy
+
+        self.pools = {name: [Voice(self) for _ in range(budget)]
+                      for name, budget in budgets.items()}
+        self.voices = [voice for pool in self.pools.values() for voice in pool]
+
+        self.mix = numpy.zeros(block_size, dtype=numpy.float32)
+        self.scratch = numpy.zeros(block_size, dtype=numpy.float32)
+        self.ramp = numpy.zeros(block_size, dtype=numpy.float32)
+        self.steps = numpy.arange(1, block_size + 1, dtype=numpy.float32)
+        self.out = numpy.zeros(block_size, dtype=numpy.int16)
+
+        # pygame sound -> its samples, which share the sound's memory
+        self.arrays = weakref.WeakKeyDictionary()
+
+        self.counters = {'played': 0, 'stolen': 0, 'dropped': 0, 'blocks': 0}
+        # decides which voice is stolen; offline rendering counts samples instead
+        self.clock = time.monotonic
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def samples(self, sound):
+        if isinstance(sound, numpy.ndarray):
+            return sound
+
+        data = self.arrays.get(sound)
+        if data is None:
+            data = pygame.sndarray.samples(sound)
+            if data.ndim > 1:
+                data = numpy.ascontiguousarray(data[:, 0])
+            self.arrays[sound] = data
+        return data
+
+    def play(self, pool_name, sound, loops=0, fade_ms=0):
+        """Starts sound on a voice of the pool and returns the voice, None if
+        it was dropped"""
+
+        data = self.samples(sound)
+        pool = self.pools[pool_name]
+        now = self.clock()
+
+        with self.lock:
+            voice = next((v for v in pool if not v.get_busy()), None)
+            if voice is None:
+                voice = self.find_victim(pool, now)
+                if voice is None:
+                    self.counters['dropped'] += 1
+                    return None
+                # crossfade: the new sound starts when the old one is silent
+                voice.fade_to(0.0, STEAL_FADE_MS)
+                voice.queued = (sound, data, loops, fade_ms)
+                self.counters['stolen'] += 1
+            else:
+                voice.start(sound, data, loops, fade_ms)
+
+            voice.started = now
+            voice.length = float('inf') if loops < 0 else len(data) * (loops + 1) / self.samplerate
+            self.counters['played'] += 1
+
+        return voice
+
+    def crossfade(self, voice, pool_name, sound, ms, loop=0):
+        """Fades voice out and sound in on another voice of the pool over ms;
+        sound starts at the position of voice within a loop of that many
+        samples, so both play in phase. Returns the new voice, None if it
+        was dropped"""
+
+        data = self.samples(sound)
+        with self.lock:
+            # the segment queued behind would start after the fade
+            voice.queued = None
+            position = 0
+            if voice.sound is not None:
+                if loop:
+                    position = voice.position % loop
+                voice.fade_to(0.0, ms)
+
+            free = next((v for v in self.pools[pool_name] if not v.get_busy()), None)
+            if free is not None:
+                free.start(sound, data, 0, ms)
+                free.position = position
+                free.started = self.clock()
+                free.length = (len(data) - position) / self.samplerate
+                self.counters['played'] += 1
+                return free
+
+        # every voice is busy, sound waits for the fade of a stolen one
+        return self.play(pool_name, sound, fade_ms=ms)
+
+    def active_voices(self):
+        return {name: sum(voice.get_busy() for voice in pool)
+                for name, pool in self.pools.items()}
+
+    def stop_all(self):
+        for voice in self.voices:
+            voice.stop()
+
+    def find_victim(self, pool, now):
+        # voices that are being stolen already are fading out
+        candidates = [v for v in pool if v.gain_target > 0.0]
+        if not candidates:
+            return None
+
+        if self.policy == 'oldest':
+            return min(candidates, key=lambda v: v.started)
+
+        return min(candidates, key=lambda v: v.length - (now - v.started))
+
+    def render_block(self, frames=None):
+        """Mixes the next block of all voices into self.out, or only its
+        first frames"""
+
+        frames = frames or self.block_size
+        mix = self.mix[:frames]
+        mix.fill(0.0)
+
+        with self.lock:
+            for voice in self.voices:
+                if voice.sound is not None:
+                    self.render_voice(voice, frames)
+
+        numpy.clip(mix, -32768.0, 32767.0, out=mix)
+        numpy.copyto(self.out[:frames], mix, casting='unsafe')
+        self.counters['blocks'] += 1
+
+        return self.out[:frames]
+
+    def render_voice(self, voice, frames):
+        done = 0
+        while done < frames and voice.sound is not None:
+            data = voice.data
+            count = min(frames - done, len(data) - voice.position)
+            if voice.gain_step and voice.gain_target == 0.0:
+                # a queued sound starts right where the fade out ends
+                count = min(count, voice.fade_length - voice.fade_done)
+
+            scratch = self.scratch[:count]
+            numpy.copyto(scratch, data[voice.position:voice.position + count],
+                         casting='unsafe')
+
+            if voice.gain_step:
+                # counted from the start of the fade, not from the last block
+                fading = min(count, voice.fade_length - voice.fade_done)
+                ramp = self.ramp[:count]
+                numpy.add(self.steps[:fading], voice.fade_done, out=ramp[:fading])
+                ramp[:fading] *= voice.gain_step
+                ramp[:fading] += voice.fade_from
+                ramp[fading:] = voice.gain_target
+                scratch *= ramp
+                voice.fade_done += fading
+                if voice.fade_done == voice.fade_length:
+                    voice.gain = voice.gain_target
+                    voice.gain_step = 0.0
+                else:
+                    voice.gain = float(ramp[fading - 1])
+            elif voice.gain != 1.0:
+                scratch *= voice.gain
+
+            if voice.volume != 1.0:
+                scratch *= voice.volume
+
+            self.mix[done:done + count] += scratch
+            done += count
+            voice.position += count
+
+            if voice.gain == 0.0 and voice.gain_target == 0.0:
+                self.finish(voice)
+            elif voice.position == len(data):
+                if voice.loops == 0:
+                    self.finish(voice)
+                else:
+                    voice.position = 0
+                    if voice.loops > 0:
+                        voice.loops -= 1
+
+    def finish(self, voice):
+        if voice.queued is not None:
+            voice.start(*voice.queued)
+        else:
+            voice.sound = voice.data = None
+
+    def start(self):
+        """Starts the thread that pushes blocks into the sink"""
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        block_time = self.block_size / self.samplerate
+        deadline = time.monotonic()
+
+        while self.running:
+            self.sink.write(self.render_block())
+
+            if self.realtime:
+                deadline += block_time
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sink.close()
@@ -0,0 +1,211 @@
+""" Input backends: the real Piano HAT and Drum HAT, or a simulation that
+replays scripted or random touch events, so the instruments can be run and
+profiled on any Linux box. """
+
+import collections
+import random
+import subprocess
+import threading
+import time
+
+# safe shutdown button is pin 14 (GND) and pin 18(IO: 24 in BCM) in BOARD numbering
+SHUTDOWN_PIN = 24
+
+PIANO_KEYS = 13
+DRUM_PADS = 8
+MAX_VELOCITY = 127
+
+# the event passed to drum handlers, like drumhat's plus a velocity, which
+# the Drum HAT doesn't sense
+DrumEvent = collections.namedtuple('DrumEvent', ['channel', 'velocity'])
+
+# one touch event of a script: seconds from the start, the kind of event
+# ('hit', 'release', 'note', 'octave_up', 'octave_down' or 'instrument'),
+# the pad or key, whether it was pressed and the velocity of hits
+Event = collections.namedtuple('Event', ['time', 'kind', 'channel', 'pressed', 'velocity'],
+                               defaults=[MAX_VELOCITY])
+
+
+class HatBackend:
+    """ Pimoroni's Piano HAT and Drum HAT libraries; imported here, so the
+    rest of the code loads without them. """
+
+    def __init__(self):
+        import drumhat
+        import pianohat
+
+        self.drumhat = drumhat
+        self.pianohat = pianohat
+
+    def on_hit(self, handler):
+        self.drumhat.on_hit(self.drumhat.PADS, handler)
+
+    def on_release(self, handler):
+        self.drumhat.on_release(self.drumhat.PADS, handler)
+
+    def on_note(self, handler):
+        self.pianohat.on_note(handler)
+
+    def on_octave_up(self, handler):
+        self.pianohat.on_octave_up(handler)
+
+    def on_octave_down(self, handler):
+        self.pianohat.on_octave_down(handler)
+
+    def on_instrument(self, handler):
+        self.pianohat.on_instrument(handler)
+
+    def auto_leds(self, enable):
+        self.pianohat.auto_leds(enable)
+
+    def set_led(self, index, state):
+        self.pianohat.set_led(index, state)
+
+    def enable_shutdown_button(self):
+        """ Powers the Pi off when the optional shutdown button is pressed. """
+
+        import RPi.GPIO as GPIO
+
+        def turn_off(pin):
+            # the argument pin is not required but passed by event_detect
+            GPIO.cleanup()
+            subprocess.call(['sudo poweroff'], shell=True)
+
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(SHUTDOWN_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(SHUTDOWN_PIN, edge=GPIO.FALLING, callback=turn_off)
+
+
+class SimulatedBackend:
+    """ Calls the registered handlers from a script of events instead of
+    touch pads. Records how long each handler took and how late it
+    returned compared to the event's scheduled time. """
+
+    def __init__(self):
+        self.handlers = {}
+        self.leds = [False] * 16
+        self.auto = False
+
+        self.events = 0
+        # seconds from calling a handler until it returned
+        self.callback_times = []
+        # seconds from the scheduled time of an event until its handler returned
+        self.latencies = []
+
+        self.thread = None
+
+    def on_hit(self, handler):
+        self.handlers['hit'] = handler
+
+    def on_release(self, handler):
+        self.handlers['release'] = handler
+
+    def on_note(self, handler):
+        self.handlers['note'] = handler
+
+    def on_octave_up(self, handler):
+        self.handlers['octave_up'] = handler
+
+    def on_octave_down(self, handler):
+        self.handlers['octave_down'] = handler
+
+    def on_instrument(self, handler):
+        self.handlers['instrument'] = handler
+
+    def auto_leds(self, enable):
+        self.auto = enable
+
+    def set_led(self, index, state):
+        self.leds[index] = state
+
+    def enable_shutdown_button(self):
+        pass
+
+    def emit(self, kind, channel, pressed=True, velocity=MAX_VELOCITY):
+        """Calls the handler of an event, returns the seconds it took"""
+
+        handler = self.handlers.get(kind)
+        if handler is None:
+            return 0.0
+
+        start = time.perf_counter()
+        if kind in ('hit', 'release'):
+            handler(DrumEvent(channel, velocity))
+        else:
+            if self.auto and kind == 'note':
+                self.leds[channel] = pressed
+            handler(channel, pressed)
+        elapsed = time.perf_counter() - start
+
+        self.events += 1
+        self.callback_times.append(elapsed)
+        return elapsed
+
+    def replay(self, script, speed=1.0):
+        """Emits the events of a script at their times; speed 0 emits them as
+        fast as possible"""
+
+        start = time.monotonic()
+        for event in script:
+            due = start + event.time / speed if speed else time.monotonic()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            self.emit(event.kind, event.channel, event.pressed, event.velocity)
+            self.latencies.append(time.monotonic() - due)
+
+    def start(self, script, speed=1.0):
+        """Replays a script in a background thread, like the HAT libraries
+        call their handlers from their own threads"""
+
+        self.thread = threading.Thread(target=self.replay, args=(script, speed),
+                                       daemon=True)
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+def random_script(rate, duration, seed=None, drum_share=0.5):
+    """Returns random pad hits and key presses at rate events per second;
+    every key press is released again after a random time"""
+
+    rng = random.Random(seed)
+    events = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            break
+
+        if rng.random() < drum_share:
+            events.append(Event(t, 'hit', rng.randrange(DRUM_PADS), True,
+                                rng.randint(1, MAX_VELOCITY)))
+        else:
+            key = rng.randrange(PIANO_KEYS)
+            events.append(Event(t, 'note', key, True))
+            events.append(Event(t + rng.uniform(0.05, 0.5), 'note', key, False))
+
+    events.sort(key=lambda event: event.time)
+    return events
+
+
+def load_script(path):
+    """Reads a script with one event per line: time kind channel [pressed
+    [velocity]]; empty lines and lines starting with # are skipped"""
+
+    events = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+
+            pressed = fields[3].lower() not in ('0', 'false', 'released') if len(fields) > 3 else True
+            velocity = int(fields[4]) if len(fields) > 4 else MAX_VELOCITY
+            events.append(Event(float(fields[0]), fields[1], int(fields[2]), pressed, velocity))
+
+    events.sort(key=lambda event: event.time)
+    return events
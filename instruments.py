@@ -0,0 +1,458 @@
+""" The instruments of RPi-Band and everything they share: the sound sets,
+the mixer and the synthesizer samples. The Piano HAT and Drum HAT are
+reached through a backend from hardware.py. """
+
+import collections
+import concurrent.futures
+import glob
+import os
+import threading
+import time
+
+import pygame
+
+import engine
+import midiout
+import soundsets
+import streaming
+import synth
+import voices
+
+# accept 8bit for the synthi, extend sound_sets by it but handle specially 
+SOUND_BASEDIR = os.path.join(os.path.dirname(__file__), "sounds/")
+
+# list of all available soundsets
+sound_sets = [os.path.basename(tmp) for tmp in glob.glob(os.path.join(SOUND_BASEDIR, "*"))]
+
+sound_sets.append("8bit")
+
+# decodes the sound sets and generates the synth banks, one thread per core
+workers = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1)
+
+# decoded sound sets, shared by all instruments
+registry = soundsets.SoundSetRegistry(SOUND_BASEDIR, executor=workers)
+
+# one output format for all instruments: the synth samples are converted
+# into it and pygame converts the .wav files while loading them, so the
+# audio device is opened once and never reset when switching instruments.
+# The buffer size sets most of the delay between a hit and its sound;
+# the smallest one that doesn't underrun depends on the Pi model.
+SAMPLERATE = 44100
+BUFFER_SIZE = 512
+CHANNELS = 32
+
+# channels reserved for the drums, the piano gets the rest; needs 2 at least
+DRUM_CHANNELS = 12
+
+# MIDI notes the synthesizer covers, C2 to C7
+SYNTH_RANGE = (36, 96)
+
+def init_mixer(samplerate=SAMPLERATE, buffer_size=BUFFER_SIZE, channels=CHANNELS,
+               backend='pygame', sink='aplay', synth_range=SYNTH_RANGE):
+    """ Sets up pygame's mixer; with the numpy backend the sounds are mixed
+    by engine.SoftwareMixer instead and pygame only decodes them. Its sink
+    'offline' leaves rendering the blocks to the caller. """
+
+    global notes, allocator, synth_low
+    if backend == 'numpy':
+        # keep pygame away from the audio device, the sink owns it
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+    pygame.mixer.pre_init(samplerate, -16, 1, buffer_size)
+    pygame.mixer.init()
+    pygame.mixer.set_num_channels(channels)
+    samplerate = pygame.mixer.get_init()[0]
+
+    # the numpy engine plays the samples of packed banks straight from the file
+    registry.arrays = backend == 'numpy'
+
+    # fewer channels are split in the same proportion, one for each at least
+    drum_channels = max(1, min(DRUM_CHANNELS, channels * DRUM_CHANNELS // CHANNELS))
+    budgets = {'drums': drum_channels, 'piano': channels - drum_channels}
+
+    if backend == 'numpy':
+        if sink == 'aplay':
+            output = engine.AplaySink(samplerate, buffer_size)
+        elif sink in ('null', 'offline'):
+            # offline, the caller renders the blocks itself
+            output = engine.NullSink()
+        else:
+            output = engine.FileSink(sink, samplerate)
+        allocator = engine.SoftwareMixer(budgets, output, samplerate, buffer_size,
+                                         realtime=(sink != 'aplay'))
+        if sink != 'offline':
+            allocator.start()
+    else:
+        allocator = voices.VoiceAllocator(budgets)
+
+    # samples are generated (or loaded from the cache) on first use, at the
+    # rate the mixer actually runs at; key 0 is the lowest note of the range
+    synth_low = synth_range[0]
+    notes = synth.LazyBank(make_sample, synth.note_frequencies(*synth_range),
+                           samplerate=samplerate,
+                           sound_bytes=lambda note: sum(map(soundsets.sound_bytes, note[:3])),
+                           executor=workers)
+
+############## synthi constants
+
+# Feel free to change the volume and the envelopes!
+volume = {'sine':0.8, 'saw':0.4, 'square':0.4}
+envelope = {'sine': synth.Envelope(attack_ms=25, decay_ms=100, sustain=0.8, release_ms=500),
+            'saw': synth.Envelope(attack_ms=10, decay_ms=200, sustain=0.6, release_ms=300),
+            'square': synth.Envelope(attack_ms=5, decay_ms=150, sustain=0.7, release_ms=250)}
+
+# the sustain segment of held keys is queued again this often
+SUSTAIN_POLL_S = synth.SEGMENT_MS / 5000.0
+
+# the sounds of a key: attack+decay, a sustain segment and the release tail,
+# and the samples of the loop they are made of
+SynthNote = collections.namedtuple('SynthNote', ['attack', 'sustain', 'release', 'loop'])
+
+wavetypes = ['sine','saw','square']
+enabled = {'sine':True, 'saw':False, 'square':False}
+
+# build a list of legal wave type combinations
+LEGAL_WAVES = [[x, y, z] for x in [True, False] for y in [True, False] for z in [True, False]]
+LEGAL_WAVES.remove([False, False, False])  # no waves gives no sound
+LEGAL_WAVES.remove([False, False, True])  # only saw gives no sound (bug?)
+
+def combination(index):
+    """Returns the names of the wavetypes enabled in LEGAL_WAVES[index]"""
+
+    return tuple(wavetypes[i] for i in range(3) if LEGAL_WAVES[index][i])
+
+def make_sample(buffers, names):
+    """Mixes the generated buffers of a wave combination into the envelope
+    segments of a key, so a key takes a single channel"""
+
+    samplerate, _, channels = pygame.mixer.get_init()
+    # the volumes balance the sounds, they are applied in the mixdown
+    segments = synth.render_envelope(buffers, [volume[name] for name in names],
+                                     [envelope[name] for name in names],
+                                     samplerate, channels)
+
+    return SynthNote(*map(pygame.sndarray.make_sound, segments), loop=len(buffers[0]))
+
+# built by init_mixer
+notes = None
+allocator = None
+synth_low = SYNTH_RANGE[0]
+
+# queues the chunks of long samples
+streamer = streaming.Streamer()
+
+############## MIDI output
+
+# General MIDI drum notes of the pads: kick, snare, closed and open hi-hat,
+# crash, clap, side stick and cowbell
+DRUM_NOTES = [36, 38, 42, 46, 49, 39, 37, 56]
+# MIDI note of the lowest key of a sample set's lowest octave, C2
+PIANO_LOW_NOTE = 36
+PIANO_VELOCITY = 100
+
+# a midiout.MidiSender, set by init_midi
+midi_out = None
+# MIDI output instead of the samples
+midi_only = False
+
+def init_midi(sender, only=False):
+    """Routes the events of both HATs to sender as well, or only to it"""
+
+    global midi_out, midi_only
+    midi_out = sender
+    midi_only = only
+
+def send_midi(kind, channel, note, velocity):
+    if midi_out is not None:
+        midi_out.send(midiout.Message(kind, channel, note, velocity))
+
+############## /MIDI output
+
+############## /synthi constants
+
+
+def play(pool_name, sound):
+    """Plays a sample of a sound set, which may be streamed"""
+
+    if midi_only:
+        return None
+    if isinstance(sound, streaming.StreamedSound):
+        return streamer.play(allocator, pool_name, sound)
+    return allocator.play(pool_name, sound)
+
+
+def load_then(hat, prepare, then):
+    """Calls prepare, which loads, on the loader thread of a
+    dispatch.DispatchBackend and then on its dispatch thread, with any
+    other hat both right away"""
+
+    defer = getattr(hat, 'defer', None)
+    if defer is None:
+        prepare()
+        then()
+    else:
+        defer(prepare, then)
+
+
+class Container:
+    """ Container is a factory for creating instruments, necessary for 
+    switching to 8-bit piano """
+
+    piano = None
+    drums = None
+    hat = None
+
+    def __init__(self, piano_index, drums_index, hat):
+        self.hat = hat
+
+        # decode both sets and generate the synth at once, the instruments
+        # are created here as soon as their sounds are ready
+        registry.preload(sound_sets[drums_index])
+        if sound_sets[piano_index] == '8bit':
+            notes.load_banks(combination(Synthesizer.wavetype_index))
+        else:
+            registry.preload(sound_sets[piano_index])
+
+        self.drums = Drums(hat, drums_index)
+        self.create_piano(piano_index)
+
+    def create_piano(self, piano_index):
+        if self.piano is not None:
+            self.piano.close()
+
+        if sound_sets[piano_index] == '8bit':
+            # synthi needs no sound_index, 0 is a dummy value
+            self.piano = Synthesizer(self, 0)  
+        else:
+            self.piano = Piano(self, piano_index)
+
+        # decode the set behind the instrument button in the meantime
+        next_index = (piano_index + 1) % len(sound_sets)
+        if sound_sets[next_index] != '8bit':
+            registry.preload(sound_sets[next_index])
+
+    def switch_piano(self, piano_index):
+        """Creates another piano once its sounds are decoded; the current
+        one keeps playing until then"""
+
+        if sound_sets[piano_index] == '8bit':
+            wavetypes = combination(Synthesizer.wavetype_index)
+            prepare = lambda: [notes.bank(wavetype) for wavetype in wavetypes]
+        else:
+            prepare = lambda: registry.get(sound_sets[piano_index])
+
+        current = self.piano
+
+        def switch():
+            # pressed again while loading, it switches only once
+            if self.piano is current:
+                self.create_piano(piano_index)
+
+        load_then(self.hat, prepare, switch)
+
+
+class Instrument:
+    sounds = []
+    sound_index = 0
+    hat = None
+
+    def __init__(self, hat, sound_index):
+        self.hat = hat
+        self.sound_index = sound_index
+        self.load_sounds()
+
+    def load_sounds(self):
+        self.sounds = registry.get(sound_sets[self.sound_index])
+
+    def close(self):
+        pass
+
+
+class Drums(Instrument):
+
+    def __init__(self, hat, sound_index):
+        super(Drums, self).__init__(hat, sound_index)
+
+        hat.on_hit(self.handle_hit)
+        hat.on_release(self.handle_release)
+
+    def load_sounds(self):
+        super(Drums, self).load_sounds()
+        # pad -> velocity -> the alternates of its layer
+        self.pads = soundsets.velocity_table(registry.names[sound_sets[self.sound_index]],
+                                             self.sounds)
+
+    def handle_hit(self, event):
+        # event.channel is a zero based channel index for each pad, the Drum
+        # HAT doesn't sense velocity, so it hits with the loudest layer
+        velocity = getattr(event, 'velocity', soundsets.VELOCITIES - 1)
+        play('drums', self.pads[event.channel][velocity].next())
+        send_midi('note_on', midiout.DRUM_CHANNEL,
+                  DRUM_NOTES[event.channel % len(DRUM_NOTES)], velocity)
+
+    def handle_release(self, event):
+        send_midi('note_off', midiout.DRUM_CHANNEL,
+                  DRUM_NOTES[event.channel % len(DRUM_NOTES)], 0)
+
+
+# maybe add a wrapper four outputting played sound  filename?
+class Piano(Instrument):
+    octave = 0
+    octaves = 0 
+    container = None
+
+    def __init__(self, container, sound_index):
+        super(Piano, self).__init__(container.hat, sound_index)
+
+        self.container = container
+        # key -> the MIDI note it started, for the note off
+        self.midi_notes = {}
+
+        self.hat.on_note(self.handle_note)
+        self.hat.on_octave_up(self.handle_octave_up)
+        self.hat.on_octave_down(self.handle_octave_down)
+        self.hat.on_instrument(self.handle_instrument)
+
+        self.hat.auto_leds(True)
+
+    def load_sounds(self):
+        super(Piano, self).load_sounds()        
+        self.octaves = len(self.sounds) / 12
+        self.octave = int(self.octaves / 2)   
+
+    # could be merged with handle_hit in Drum, but that'd be obfuscating
+    def handle_note(self, channel, pressed):
+        self.send_note(channel, pressed, PIANO_LOW_NOTE + channel + 12 * self.octave)
+        channel = channel + (12 * self.octave)
+
+        if channel < len(self.sounds) and pressed:
+            play('piano', self.sounds[channel])
+
+    def send_note(self, channel, pressed, note):
+        """Sends a key to the MIDI output; the note off goes to the note the
+        key started, even if the octave changed meanwhile"""
+
+        if midi_out is None:
+            return
+        if pressed:
+            self.midi_notes[channel] = note
+            send_midi('note_on', 0, note, PIANO_VELOCITY)
+        elif channel in self.midi_notes:
+            send_midi('note_off', 0, self.midi_notes.pop(channel), 0)
+
+    def handle_instrument(self, channel, pressed):
+        if pressed:
+            self.container.switch_piano((self.sound_index + 1) % len(sound_sets))
+
+    def handle_octave_up(self, channel, pressed):
+        if pressed and self.octave < int(self.octaves) - 1:
+            self.octave += 1
+
+    def handle_octave_down(self, channel, pressed):
+        if pressed and self.octave > 0:
+            self.octave -= 1
+
+
+class Synthesizer(Piano):
+    """ Octave up/down change the octave like on the piano; the instrument
+    button cycles through the wave combinations and, after the last one,
+    on to the next sound set. A key plays its attack+decay segment and
+    queues the sustain segment, which a thread keeps queueing while the
+    key is held; when it is let go, the playing segment is crossfaded
+    into the release tail on another voice. """
+
+    wavetype_index = 0
+
+    def __init__(self, container, sound_index):
+        super(Synthesizer, self).__init__(container,  sound_index)   
+
+        # key -> (channel, SynthNote) of the voice started by the key
+        self.held = {}
+        # keeps the sustainer from queueing over a release
+        self.lock = threading.Lock()
+
+        self.prewarm()
+
+        self.running = True
+        self.sustainer = threading.Thread(target=self.sustain, daemon=True)
+        self.sustainer.start()
+
+    def close(self):
+        # held notes end with their current segment
+        self.running = False
+
+    def prewarm(self):
+        """Builds the current wave combination in the background, nearest
+        octaves first"""
+
+        first = 12 * self.octave
+        notes.prewarm(combination(self.wavetype_index),
+                      sorted(range(len(notes.frequencies)), key=lambda k: abs(k - first - 6)))
+
+    def switch_waves(self, index):
+        # pressed again while loading, or replaced, it switches only once
+        if self.wavetype_index == index - 1 and self.container.piano is self:
+            self.wavetype_index = index
+            self.prewarm()
+
+    def load_sounds(self):
+        # the 13 keys span 12 semitones, octave 0 starts at the lowest note
+        self.octaves = (len(notes.frequencies) - 13) // 12 + 1
+        # start at middle C, if it is in range
+        self.octave = min(max(0, (60 - synth_low) // 12), self.octaves - 1)
+
+    def handle_note(self, channel, pressed):
+        """Handles the piano keys
+        The mixdown of the enabled waves is played, and turned off if the key is released
+        """
+
+        self.send_note(channel, pressed, synth_low + channel + 12 * self.octave)
+        if midi_only:
+            return
+
+        if pressed:
+            key = channel + 12 * self.octave
+
+            note = notes.get(combination(self.wavetype_index), key)
+            voice = allocator.play('piano', note.attack)
+            if voice is not None:
+                # a stolen voice has the attack queued, the sustainer follows up
+                if voice.get_queue() is None:
+                    voice.queue(note.sustain)
+                self.held[channel] = (voice, note)
+        elif channel in self.held:
+            with self.lock:
+                voice, note = self.held.pop(channel)
+                # the voice may have been stolen by another key meanwhile
+                if self.owns(voice, note):
+                    # the release starts now, not after the playing segment
+                    allocator.crossfade(voice, 'piano', note.release,
+                                        voices.STEAL_FADE_MS, note.loop)
+
+    def owns(self, voice, note):
+        """Returns whether voice still plays note and isn't being stolen"""
+
+        return ((voice.get_sound() is note.attack or voice.get_sound() is note.sustain)
+                and (voice.get_queue() is None or voice.get_queue() is note.sustain))
+
+    def sustain(self):
+        while self.running:
+            time.sleep(SUSTAIN_POLL_S)
+            self.requeue()
+
+    def requeue(self):
+        """Queues the sustain segment behind the playing one for held keys"""
+
+        with self.lock:
+            for voice, note in list(self.held.values()):
+                if voice.get_queue() is None and self.owns(voice, note):
+                    voice.queue(note.sustain)
+
+    def handle_instrument(self, channel, pressed):
+        if pressed and self.wavetype_index < len(LEGAL_WAVES) - 1:
+            index = self.wavetype_index + 1
+            load_then(self.hat,
+                      lambda: [notes.bank(wavetype) for wavetype in combination(index)],
+                      lambda: self.switch_waves(index))
+        else:
+            super(Synthesizer, self).handle_instrument(channel, pressed)
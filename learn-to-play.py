@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import glob
 import os
 import signal
+import sys
 import time
 from sys import exit
 
@@ -12,40 +14,144 @@ except ImportError:
 
 import pianohat
 
+import scheduler
+
 
 print("""
 This example will teach you to play a simple melody
 by lighting up the keys you must press.
 
+The instrument button switches to the next melody,
+octave up and down make it faster or slower.
+
 Press CTRL+C to exit.
 """)
 
 SOUNDS = os.path.join(os.path.dirname(__file__), "sounds/piano")
+MELODIES = os.path.join(os.path.dirname(__file__), "melodies")
+
+# seconds the LEDs stay dark between two notes
+LED_GAP = 0.1
+# beats per minute the octave buttons change the tempo by
+TEMPO_STEP = 10
 
 pygame.mixer.pre_init(44100, -16, 1, 512)
 pygame.mixer.init()
 pygame.mixer.set_num_channels(16)
 
-melody = [
-    0, 0, 7, 7, 9, 9, 7,
-    5, 5, 4, 4, 2, 2, 0
-]
 
+def load_melody(path):
+    """Reads a melody file: a tempo line and keys, optionally with :beats"""
+
+    melody = {'name': os.path.splitext(os.path.basename(path))[0], 'tempo': 100, 'notes': []}
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if fields[0] == 'tempo':
+                melody['tempo'] = float(fields[1])
+                continue
+
+            for field in fields:
+                key, _, beats = field.partition(':')
+                melody['notes'].append((int(key), float(beats or 1)))
+
+    return melody
+
+
+melodies = [load_melody(path) for path in sys.argv[1:] or sorted(glob.glob(os.path.join(MELODIES, '*.txt')))]
+if not melodies:
+    exit("No melodies found in {}".format(MELODIES))
+
+melody_index = 0
+tempo = melodies[0]['tempo']
+
+# position in the melody and the state of the current run through it
 note = 0
-starting_note = 45
+started = 0.0
+beats = 0.0
+scores = []
+misses = 0
 
 
-def next():
-    global note
-    pianohat.set_led(current_note(), False)
-    time.sleep(0.1)
-    note += 1
-    note %= len(melody)
-    pianohat.set_led(current_note(), True)
+def current_melody():
+    return melodies[melody_index]
 
 
 def current_note():
-    return melody[note]
+    return current_melody()['notes'][note][0]
+
+
+def light(position):
+    """Lights the key of a position, unless the player moved on already"""
+
+    if position == note:
+        pianohat.set_led(current_note(), True)
+
+
+def restart():
+    """Starts the current melody from its first note"""
+
+    global note, beats, scores, misses
+    note = 0
+    beats = 0.0
+    scores = []
+    misses = 0
+
+    events.call_soon(show_start, current_melody()['name'], tempo)
+
+
+def show_start(name, tempo):
+    for x in range(16):
+        pianohat.set_led(x, False)
+    print('{} at {:.0f} bpm'.format(name, tempo))
+    light(0)
+
+
+def show_note(key, error, score):
+    if error is None:
+        print('Playing Sound: {}'.format(files[key]))
+    else:
+        print('Playing Sound: {} {:+.0f} ms, {:.0f} points'.format(files[key], 1000 * error, score))
+
+
+def show_result(name, scores, misses, played_tempo):
+    print('{}: {:.0f} points on average, {} wrong keys, played at {:.0f} bpm\n'.format(
+        name, sum(scores) / len(scores) if scores else 0.0, misses, played_tempo))
+
+
+def score(error):
+    """Rates a timing error: 100 on the beat, 0 half a beat or more off"""
+
+    return max(0.0, 1.0 - abs(error) / (30.0 / tempo)) * 100
+
+
+def next(now):
+    """Moves on to the next note; the LEDs are switched by the scheduler"""
+
+    global note, started, beats
+    melody = current_melody()
+    key, length = melody['notes'][note]
+
+    if note == 0:
+        started = now
+        error = None
+    else:
+        error = now - (started + beats * 60.0 / tempo)
+        scores.append(score(error))
+
+    events.call_soon(pianohat.set_led, key, False)
+    events.call_soon(show_note, key, error, scores[-1] if scores else 0.0)
+
+    beats += length
+    note += 1
+    if note == len(melody['notes']):
+        played_tempo = 60.0 * (beats - length) / (now - started) if now > started else tempo
+        events.call_soon(show_result, melody['name'], scores, misses, played_tempo)
+        restart()
+    else:
+        events.call_later(LED_GAP, light, note)
 
 
 files = [
@@ -68,37 +174,53 @@ samples = [pygame.mixer.Sound(os.path.join(SOUNDS, sample)) for sample in files]
 
 pianohat.auto_leds(False)
 
+# LED transitions and printing run here, the touch callbacks never wait
+events = scheduler.Scheduler()
+events.start()
+
 
 def handle_note(channel, pressed):
+    global misses
+    if not pressed:
+        return
+
+    now = time.monotonic()
     if not channel == current_note():
+        misses += 1
         return
 
-    if channel < len(samples) and pressed:
-        print('Playing Sound: {}'.format(files[channel]))
+    if channel < len(samples):
         samples[channel].play(loops=0)
-        next()
+        next(now)
 
 
 def handle_instrument(channel, pressed):
-    pass
+    global melody_index, tempo
+    if pressed:
+        melody_index = (melody_index + 1) % len(melodies)
+        tempo = current_melody()['tempo']
+        restart()
 
 
 def handle_octave_up(channel, pressed):
-    pass
+    global tempo
+    if pressed:
+        tempo += TEMPO_STEP
+        restart()
 
 
 def handle_octave_down(channel, pressed):
-    pass
-
+    global tempo
+    if pressed and tempo > TEMPO_STEP:
+        tempo -= TEMPO_STEP
+        restart()
 
-for x in range(16):
-    pianohat.set_led(x, False)
 
 pianohat.on_note(handle_note)
 pianohat.on_octave_up(handle_octave_up)
 pianohat.on_octave_down(handle_octave_down)
 pianohat.on_instrument(handle_instrument)
 
-pianohat.set_led(current_note(), True)
+restart()
 
 signal.pause()
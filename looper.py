@@ -0,0 +1,158 @@
+""" A loop sequencer: the pad hits and key presses of a few bars are
+recorded and then played again and again under the live playing. Every
+repetition is computed from the start of its pattern on the monotonic
+clock, never by adding up sleeps, and handed to the scheduler a little
+ahead of time, so the loops stay on tempo over a long set. When due, the
+events are queued for the dispatch thread like the touch events. """
+
+import threading
+import time
+
+import hardware
+import scheduler
+import stats
+
+BEATS_PER_BAR = 4
+
+# the events of the next LOOKAHEAD_S are scheduled every INTERVAL_S
+LOOKAHEAD_S = 0.1
+INTERVAL_S = 0.025
+
+# events a loop repeats; the octave and instrument buttons change the
+# instrument that plays them instead
+LOOPED = ('hit', 'release', 'note')
+
+
+class Pattern:
+    """ The events of one recorded loop as (offset in seconds, event) and
+    the next one to schedule; loop 0 is the recording itself. """
+
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+        # (offset, (kind, channel, pressed, velocity)), in the order played
+        self.events = []
+        self.cursor = 0
+        self.loop = 0
+
+    def due(self, until):
+        """Returns the times and events before until, moves on past them"""
+
+        due = []
+        while self.events:
+            offset, event = self.events[self.cursor]
+            when = self.start + self.loop * self.length + offset
+            if when >= until:
+                break
+
+            due.append((when, event))
+            self.cursor += 1
+            if self.cursor == len(self.events):
+                self.cursor = 0
+                self.loop += 1
+
+        return due
+
+
+class Looper:
+    """ Records a loop of bars from the first event after the last one
+    ended, up to layers loops that play on top of each other. Gets the
+    events from recorder.RecordingBackend, like a recorder, and plays
+    them through a dispatch.DispatchBackend. """
+
+    def __init__(self, tempo=120.0, bars=1, layers=1, beats_per_bar=BEATS_PER_BAR):
+        self.length = bars * beats_per_bar * 60.0 / tempo
+        self.layers = layers
+        self.dispatcher = None
+
+        self.patterns = []
+        self.recording = None
+        # the first pattern starts the bar grid all others are aligned to
+        self.origin = None
+        self.lock = threading.Lock()
+
+        self.events = scheduler.Scheduler()
+        # events up to here are in the scheduler's queue
+        self.until = 0.0
+
+        # seconds from the due time of an event until it was played
+        self.lateness = stats.Histogram()
+
+    def record(self, kind, channel, pressed=True, velocity=hardware.MAX_VELOCITY):
+        if kind not in LOOPED:
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            if self.recording is not None and now >= self.recording.start + self.length:
+                self.finish(self.recording)
+            if self.recording is None:
+                if len(self.patterns) >= self.layers:
+                    return
+                if self.origin is None:
+                    self.origin = now
+                start = now - (now - self.origin) % self.length
+                self.recording = Pattern(start, self.length)
+                self.events.call_at(start + self.length, self.close, self.recording)
+
+            self.recording.events.append((now - self.recording.start,
+                                          (kind, channel, pressed, velocity)))
+
+    def close(self, pattern):
+        with self.lock:
+            if self.recording is pattern:
+                self.finish(pattern)
+
+    def finish(self, pattern):
+        """Ends the recording; keys still held are let go at the end of
+        the loop, so no synth note hangs"""
+
+        held = {}
+        for _, (kind, channel, pressed, _) in pattern.events:
+            if kind == 'note':
+                held[channel] = pressed
+        pattern.events += [(pattern.length, ('note', channel, False, 0))
+                           for channel, pressed in sorted(held.items()) if pressed]
+
+        pattern.loop = 1
+        self.recording = None
+        self.add(pattern)
+
+    def add(self, pattern):
+        """Plays a pattern from its next loop on"""
+
+        self.patterns.append(pattern)
+        # the window the last tick scheduled already began
+        for when, event in pattern.due(self.until):
+            self.events.call_at(when, self.play, when, event)
+
+    def tick(self, when):
+        """Schedules the events of the next window, then itself again
+        INTERVAL_S after when"""
+
+        with self.lock:
+            self.until = when + LOOKAHEAD_S
+            due = [entry for pattern in self.patterns for entry in pattern.due(self.until)]
+
+        for due_time, event in due:
+            self.events.call_at(due_time, self.play, due_time, event)
+        self.events.call_at(when + INTERVAL_S, self.tick, when + INTERVAL_S)
+
+    def play(self, when, event):
+        self.lateness.add(time.monotonic() - when)
+
+        # the handlers only run on the dispatch thread
+        self.dispatcher.put(*event)
+
+    def start(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.events.start()
+        now = time.monotonic()
+        self.events.call_at(now, self.tick, now)
+
+    def stop(self):
+        self.events.stop()
+
+    def snapshot(self):
+        return {'patterns': len(self.patterns), 'recording': self.recording is not None,
+                'lateness': self.lateness.snapshot()}
@@ -20,45 +20,43 @@ except ImportError:
 
 import pianohat
 
+import midiout
 
-hw = midi.sequencer.SequencerHardware()
 
 octave = 5
-MIDI_CLIENT = -1
 MIDI_PORT   = 0
 START_PATCH = 1
 BANK_SIZE   = 16
 
-supported = ['yoshimi','SunVox']
+found = midiout.find_client(midiout.SUPPORTED_CLIENTS)
+if found is None:
+    exit('Please install and run a supported client! :)')
 
-for client in supported:
-    if client in hw._clients:
-        MIDI_CLIENT = hw._clients[client].client
-        print('Connecting to {}'.format(client))
-        break
+print('Connecting to {}'.format(found[0]))
+MIDI_CLIENT = found[1]
 
-if MIDI_CLIENT == -1:
-    exit('Please install and run a supported client! :)')
+# printed by a background thread, the touch callbacks only queue the lines
+log, log_listener = midiout.async_logger('midi-piano')
 
 class Piano():
     def __init__(self):
         self.current_patch = START_PATCH
-        self.seq = midi.sequencer.SequencerWrite()
-        self.seq.subscribe_port(MIDI_CLIENT, MIDI_PORT)
-        self.seq.start_sequencer()
+        # the sequencer is only written from the sender's thread
+        self.sender = midiout.MidiSender(midiout.AlsaOutput(MIDI_CLIENT, MIDI_PORT))
+        self.sender.start()
         self.select_patch(self.current_patch)
     
     def note_on(self, note, velocity=100):
-        self.seq.event_write(midi.NoteOnEvent(velocity=velocity, pitch=note, tick=0), False, False, True)
-        print("Note_on:{}".format(note))
+        self.sender.send(midiout.Message('note_on', 0, note, velocity))
+        log.info("Note_on:%d", note)
     def note_off(self, note):
-        self.seq.event_write(midi.NoteOffEvent(velocity=100, pitch=note, tick=0), False, False, True)
-        print("Note_off:{}".format(note))
+        self.sender.send(midiout.Message('note_off', 0, note, 100))
+        log.info("Note_off:%d", note)
 
     def select_patch(self, patch):
         if patch < 0 or patch >= BANK_SIZE:
             raise ArgumentError("Invalid Patch")
-        self.seq.event_write(midi.ProgramChangeEvent(tick=0, channel=0, data=[patch]), False, False, True)
+        self.sender.send(midiout.Message('program', 0, patch, 0))
 
     def next_patch(self):
         self.current_patch += 1
@@ -82,17 +80,25 @@ def handle_octave_up(channel, pressed):
     global octave
     if pressed:
         octave += 1
-        print('Selected Octave: {}'.format(octave))
+        log.info('Selected Octave: %d', octave)
 
 def handle_octave_down(channel, pressed):
     global octave
     if pressed and octave > 0:
         octave -= 1
-        print('Selected Octave: {}'.format(octave))
+        log.info('Selected Octave: %d', octave)
 
 pianohat.on_note(handle_note)
 pianohat.on_octave_up(handle_octave_up)
 pianohat.on_octave_down(handle_octave_down)
 pianohat.on_instrument(handle_instrument)
 
-signal.pause()
+try:
+    signal.pause()
+except KeyboardInterrupt:
+    pass
+finally:
+    piano.sender.stop()
+    log_listener.stop()
+    print('MIDI output: {}'.format(piano.sender.snapshot()))
+
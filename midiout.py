@@ -0,0 +1,194 @@
+""" MIDI output off the touch callbacks: messages are put into a queue and a
+sender thread hands everything that arrived meanwhile to the output, so a
+key press never waits on the ALSA sequencer. """
+
+import collections
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+import stats
+
+# kind is 'note_on', 'note_off' or 'program'; program changes carry the
+# program in note
+Message = collections.namedtuple('Message', ['kind', 'channel', 'note', 'velocity'])
+
+# synths that are connected to when no client is named
+SUPPORTED_CLIENTS = ['yoshimi', 'SunVox']
+
+# the General MIDI percussion channel 10, counted from 0
+DRUM_CHANNEL = 9
+
+# the messages a loopback output keeps
+LOOPBACK_MESSAGES = 10000
+
+
+def coalesce(batch):
+    """Drops the program changes of a batch that a later one of the same
+    channel overrides; the order of everything else is kept"""
+
+    last_program = {}
+    for index, (_, message) in enumerate(batch):
+        if message.kind == 'program':
+            last_program[message.channel] = index
+
+    return [(queued, message) for index, (queued, message) in enumerate(batch)
+            if message.kind != 'program' or last_program[message.channel] == index]
+
+
+def find_client(names=SUPPORTED_CLIENTS):
+    """Returns the name and number of the first running ALSA sequencer
+    client of names, None if none of them runs"""
+
+    import midi.sequencer
+
+    clients = midi.sequencer.SequencerHardware()._clients
+    for name in names:
+        if name in clients:
+            return name, clients[name].client
+    return None
+
+
+class LoopbackOutput:
+    """ Keeps the latest messages with the time they were written instead of
+    sending them, for testing and measuring. """
+
+    def __init__(self):
+        self.messages = collections.deque(maxlen=LOOPBACK_MESSAGES)
+
+    def write(self, messages):
+        now = time.monotonic()
+        self.messages.extend((now, message) for message in messages)
+
+    def close(self):
+        pass
+
+
+class FileOutput:
+    """ Writes one line per message: seconds since the start, kind, channel,
+    note and velocity. """
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+        self.started = time.monotonic()
+
+    def write(self, messages):
+        elapsed = time.monotonic() - self.started
+        for message in messages:
+            self.file.write('{:.6f} {} {} {} {}\n'.format(elapsed, *message))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class AlsaOutput:
+    """ Writes messages to a client of the ALSA sequencer with python-midi,
+    which is imported here, so the rest of the code loads without it.
+    python-midi sends and drains every event on its own, so a batch is
+    written message by message. """
+
+    def __init__(self, client, port=0):
+        import midi
+        import midi.sequencer
+
+        self.midi = midi
+        self.seq = midi.sequencer.SequencerWrite()
+        self.seq.subscribe_port(client, port)
+        self.seq.start_sequencer()
+
+    def event(self, message):
+        if message.kind == 'note_on':
+            return self.midi.NoteOnEvent(tick=0, channel=message.channel,
+                                         pitch=message.note, velocity=message.velocity)
+        if message.kind == 'note_off':
+            return self.midi.NoteOffEvent(tick=0, channel=message.channel,
+                                          pitch=message.note, velocity=message.velocity)
+        return self.midi.ProgramChangeEvent(tick=0, channel=message.channel, data=[message.note])
+
+    def write(self, messages):
+        for message in messages:
+            self.seq.event_write(self.event(message), False, False, True)
+
+    def close(self):
+        pass
+
+
+class MidiSender:
+    """ Sends messages to an output from a dedicated thread. Counts the
+    messages, the batches they were written in and the queue depth, and
+    times every message from send() until it was written. """
+
+    def __init__(self, output):
+        self.output = output
+        self.queue = queue.Queue()
+        self.latency = stats.Histogram()
+        self.counters = {'messages': 0, 'batches': 0, 'coalesced': 0, 'max_depth': 0}
+        self.thread = None
+
+    def send(self, message):
+        """Queues a message, returns immediately"""
+
+        self.queue.put((time.perf_counter(), message))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # everything that arrived while the last batch was written
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            batch = [entry for entry in batch if entry is not None]
+            self.counters['max_depth'] = max(self.counters['max_depth'], len(batch))
+
+            messages = coalesce(batch)
+            self.output.write([message for _, message in messages])
+
+            written = time.perf_counter()
+            for queued, _ in messages:
+                self.latency.add(written - queued)
+            self.counters['messages'] += len(messages)
+            self.counters['coalesced'] += len(batch) - len(messages)
+            self.counters['batches'] += 1
+
+            if stop:
+                return
+
+    def stop(self):
+        """Writes the queued messages and ends the thread"""
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.output.close()
+
+    def snapshot(self):
+        return dict(self.counters, depth=self.queue.qsize(), latency=self.latency.snapshot())
+
+
+def async_logger(name):
+    """Returns a logger whose records are printed by a background thread,
+    and the listener to stop at exit"""
+
+    records = queue.Queue()
+    listener = logging.handlers.QueueListener(records, logging.StreamHandler(sys.stdout))
+    listener.start()
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.propagate = False
+
+    return logger, listener
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+
+import pygame
+
+import instruments
+import soundbank
+import soundsets
+
+DESCRIPTION = '''Packs sound sets into bank files (sounds/<set>/<set>.bank), which rpi-band.py loads instead of the .wav files.
+The samples are converted for the sample rate given here, which has to match the one rpi-band.py runs at.
+Pack a set again after changing its files, until then rpi-band.py decodes the .wav files.'''
+
+
+def parse_arguments(sysargs):
+    """ Setup the command line options. """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('sets', nargs='*',
+                        help='names of the sets in sounds/ to pack (default: all)')
+    parser.add_argument('-r', '--samplerate', type=int, default=instruments.SAMPLERATE,
+                        help='sample rate of the bank in Hz (default: %(default)s)')
+
+    return parser.parse_args(sysargs)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+
+    sets = args.sets or [name for name in instruments.sound_sets if name != '8bit']
+    for name in sets:
+        if name not in instruments.sound_sets or name == '8bit':
+            sys.exit('there is no sound set {}'.format(name))
+
+    # the same format as instruments.init_mixer, without an audio device
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.mixer.pre_init(args.samplerate, -16, 1)
+    pygame.mixer.init()
+
+    for name in sets:
+        start = time.perf_counter()
+        path = soundbank.pack(os.path.join(instruments.SOUND_BASEDIR, name),
+                              soundsets.natural_sort_key)
+        print('{}: {} kB in {:.0f} ms'.format(path, os.path.getsize(path) // 1024,
+                                              1000 * (time.perf_counter() - start)))
@@ -0,0 +1,157 @@
+""" Recording of performances: every touch event is appended to a compact
+binary log with its time on the monotonic clock. The renderer replays a
+log through the instruments and the numpy engine into a .wav file, sample
+accurately and much faster than real time, so the same log always gives
+the same file. """
+
+import json
+import struct
+import threading
+import time
+
+import engine
+import hardware
+import instruments
+
+MAGIC = b'RPIREC01'
+
+# seconds from the start, kind, pad or key, pressed, velocity
+RECORD = struct.Struct('<dBBBB')
+KINDS = ['hit', 'release', 'note', 'octave_up', 'octave_down', 'instrument']
+
+# after the last event, the rendering goes on in steps of this until all
+# voices are silent; held synth notes never end, so at most MAX_TAIL_S
+TAIL_STEP_S = 0.1
+MAX_TAIL_S = 10.0
+
+
+class Recorder:
+    """ Appends events to a log file; the header keeps what the renderer
+    needs to set up the same instruments. """
+
+    def __init__(self, path, setup):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+
+        header = json.dumps(setup).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.started = time.monotonic()
+
+    def record(self, kind, channel, pressed=True, velocity=hardware.MAX_VELOCITY):
+        data = RECORD.pack(time.monotonic() - self.started, KINDS.index(kind),
+                           channel, pressed, velocity)
+        with self.lock:
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingBackend:
+    """ Wraps an input backend and records every event before its handler
+    runs. """
+
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def drum_handler(self, kind, handler):
+        def recorded(event):
+            self.recorder.record(kind, event.channel, True,
+                                 getattr(event, 'velocity', hardware.MAX_VELOCITY))
+            handler(event)
+        return recorded
+
+    def piano_handler(self, kind, handler):
+        def recorded(channel, pressed):
+            self.recorder.record(kind, channel, pressed)
+            handler(channel, pressed)
+        return recorded
+
+    def on_hit(self, handler):
+        self.backend.on_hit(self.drum_handler('hit', handler))
+
+    def on_release(self, handler):
+        self.backend.on_release(self.drum_handler('release', handler))
+
+    def on_note(self, handler):
+        self.backend.on_note(self.piano_handler('note', handler))
+
+    def on_octave_up(self, handler):
+        self.backend.on_octave_up(self.piano_handler('octave_up', handler))
+
+    def on_octave_down(self, handler):
+        self.backend.on_octave_down(self.piano_handler('octave_down', handler))
+
+    def on_instrument(self, handler):
+        self.backend.on_instrument(self.piano_handler('instrument', handler))
+
+
+def read_log(path):
+    """Returns the setup and the events of a log; a record cut off by a
+    crash is skipped"""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is no recording'.format(path))
+
+    start = len(MAGIC) + 4
+    header_size = struct.unpack('<I', data[len(MAGIC):start])[0]
+    setup = json.loads(data[start:start + header_size].decode())
+
+    body = data[start + header_size:]
+    body = body[:len(body) - len(body) % RECORD.size]
+    events = [hardware.Event(t, KINDS[kind], channel, bool(pressed), velocity)
+              for t, kind, channel, pressed, velocity in RECORD.iter_unpack(body)]
+    events.sort(key=lambda event: event.time)
+
+    return setup, events
+
+
+def render(log_path, wav_path, block_size=engine.BLOCK_SIZE):
+    """Replays a log into a .wav file, returns the seconds of audio"""
+
+    setup, events = read_log(log_path)
+    instruments.init_mixer(setup['samplerate'], block_size, setup['channels'],
+                           'numpy', 'offline', tuple(setup['synth_range']))
+    mixer = instruments.allocator
+    samplerate = mixer.samplerate
+    sink = engine.FileSink(wav_path, samplerate)
+
+    # the mixer steals voices by the rendered time, not the wall clock
+    position = [0]
+    mixer.clock = lambda: position[0] / float(samplerate)
+
+    hat = hardware.SimulatedBackend()
+    container = instruments.Container(instruments.sound_sets.index(setup['piano']),
+                                      instruments.sound_sets.index(setup['drums']), hat)
+
+    def render_until(target):
+        while position[0] < target:
+            # what the sustain and streaming threads do in real time
+            if isinstance(container.piano, instruments.Synthesizer):
+                container.piano.requeue()
+            instruments.streamer.poll()
+
+            frames = min(block_size, target - position[0])
+            sink.write(mixer.render_block(frames))
+            position[0] += frames
+
+    for event in events:
+        render_until(int(round(event.time * samplerate)))
+        hat.emit(event.kind, event.channel, event.pressed, event.velocity)
+
+    end = position[0] + int(MAX_TAIL_S * samplerate)
+    while position[0] < end and any(mixer.active_voices().values()):
+        render_until(position[0] + int(TAIL_STEP_S * samplerate))
+
+    container.piano.close()
+    sink.close()
+
+    return position[0] / float(samplerate)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+
+import engine
+import recorder
+
+DESCRIPTION = '''Renders a performance recorded with rpi-band.py --record into a .wav file.
+The events are replayed through the same sound sets and mixed by the numpy engine, faster than real time;
+rendering the same recording again gives the same file, byte for byte.'''
+
+
+def parse_arguments(sysargs):
+    """ Setup the command line options. """
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('recording')
+    parser.add_argument('output', help='the .wav file to write')
+    parser.add_argument('-b', '--block', type=int, default=engine.BLOCK_SIZE,
+                        help='samples mixed at once (default: %(default)s)')
+
+    return parser.parse_args(sysargs)
+
+
+if __name__ == "__main__":
+    args = parse_arguments(sys.argv[1:])
+
+    # pygame only decodes, there is no audio device
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+    start = time.perf_counter()
+    seconds = recorder.render(args.recording, args.output, args.block)
+    elapsed = time.perf_counter() - start
+    print('{}: {:.1f} s of audio in {:.1f} s, {:.0f}x real time'.format(
+        args.output, seconds, elapsed, seconds / elapsed if elapsed else 0.0))
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
-import glob
-import math
-import numpy
-import os
 import pygame
-import re
-import signal
-import subprocess
 import sys
 import time
 
-import drumhat
-import pianohat
-import RPi.GPIO as GPIO
+import dispatch
+import hardware
+import instruments
+import looper
+import midiout
+import recorder
+import soundsets
+import stats
+import streaming
 
 DESCRIPTION = '''This script integrates Pimoronis Piano HAT and Drum HAT software and gives you simple, ready-to-play instruments which use .wav files located in sounds.
 The parameter -p expects the name of the directory containing the sounds that should be loaded onto the piano HAT first
@@ -24,117 +23,8 @@ For the 8-Bit-synthesizer, pass "8bit" for -p.
 
 Press CTRL+C to exit.'''
 
-# accept 8bit for the synthi, extend sound_sets by it but handle specially 
-SOUND_BASEDIR = os.path.join(os.path.dirname(__file__), "sounds/")
-
-# list of all available soundsets
-sound_sets = [os.path.basename(tmp) for tmp in glob.glob(os.path.join(SOUND_BASEDIR, "*"))]
-
-sound_sets.append("8bit")
-
-GPIO.setmode(GPIO.BCM)
-
-# safe shutdown button is pin 14 (GND) and pin 18(IO: 24 in BCM) in BOARD numbering
-GPIO.setup(24, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-MIXER_NORMAL = (44100, -16, 1, 512)
-MIXER_8BIT = (44100, -8, 4, 256)
-
-# needs to happen before generate_samples
-def set_mixer(mixer_values):
-    pygame.mixer.quit()
-    pygame.mixer.pre_init(*mixer_values)
-    pygame.mixer.init()
-    pygame.mixer.set_num_channels(32)
-
-# needs to be 8bit first for generating samples; is changed according to
-# the chosen instrument later on
-set_mixer(MIXER_8BIT)
-
-############## synthi constants
-SAMPLERATE = 44100
-BITRATE = 8
-
-ATTACK_MS = 25
-RELEASE_MS = 500
-
-# Feel free to change the volume!
-volume = {'sine':0.8, 'saw':0.4, 'square':0.4}
-
-wavetypes = ['sine','saw','square']
-enabled = {'sine':True, 'saw':False, 'square':False}
-
-# build a list of legal wave type combinations
-LEGAL_WAVES = [[x, y, z] for x in [True, False] for y in [True, False] for z in [True, False]]
-LEGAL_WAVES.remove([False, False, False])  # no waves gives no sound
-LEGAL_WAVES.remove([False, False, True])  # only saw gives no sound (bug?)
-
-notes = {'sine':[],'saw':[],'square':[]}
-
-# The samples are 8bit signed, from -127 to +127
-# so the max amplitude of a sample is 127
-max_sample = 2**(BITRATE - 1) - 1
-
-def wave_sine(freq, time):
-    """Generates a single sine wave sample"""
-
-    s = math.sin(2*math.pi*freq*time)
-    return int(round(max_sample * s ))
-
-
-def wave_square(freq, time):
-    """Generates a single square wave sample"""
-
-    return -max_sample if freq*time < 0.5 else max_sample
-
-
-def wave_saw(freq, time):
-    """Generates a single sav wave sample"""
-
-    s = ((freq*time)*2) - 1
-    return int(round(max_sample * s)) 
-
-# IMPORTANT
-def generate_sample(frequency, volume=1.0, wavetype=None):
-    """Generates a sample of a specific frequency and wavetype"""
-    if wavetype is None:
-        wavetype = wave_square
-
-    sample_count = int(round(SAMPLERATE/frequency))
-
-    buf = numpy.zeros((sample_count, 2), dtype = numpy.int8)
-
-    for s in range(sample_count):
-        t = float(s)/SAMPLERATE # Time index
-        buf[s][0] = wavetype(frequency, t)
-        buf[s][1] = buf[s][0] # Copy to stero channel
-
-    sound = pygame.sndarray.make_sound(buf)
-    sound.set_volume(volume) # Set the volume to balance sounds
-
-    return sound
-
-# generate samples
-for f in [
-        261.626,
-        277.183,
-        293.665,
-        311.127,
-        329.628,
-        349.228,
-        369.994,
-        391.995,
-        415.305,
-        440.000,
-        466.164,
-        493.883,
-        523.251
-    ]:
-    notes['sine'] += [generate_sample(f, volume=volume['sine'], wavetype=wave_sine)]
-    notes['saw'] += [generate_sample(f, volume=volume['saw'], wavetype=wave_saw)]
-    notes['square'] += [generate_sample(f, volume=volume['square'], wavetype=wave_square)]
-
-############## /synthi constants
+# buffer sizes tried by --measure-latency
+BUFFER_SIZES = [64, 128, 256, 512, 1024, 2048]
 
 
 def parse_arguments(sysargs):
@@ -143,154 +33,254 @@ def parse_arguments(sysargs):
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument('-p', '--piano', default='piano')
     parser.add_argument('-d', '--drums', default='drums2')
-
-    return parser.parse_args(sysargs)
-
-
-def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
-    return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, s)]
-
-
-class Container:
-    """ Container is a factory for creating instruments, necessary for 
-    switching to 8-bit piano """
-
-    piano = None
-    drums = None
-
-    def __init__(self, piano_index, drums_index):
-        self.drums = Drums(drums_index)
-        self.create_piano(piano_index)
-
-        signal.pause()
-
-    def create_piano(self, piano_index):
-        if sound_sets[piano_index] == '8bit':
-            # synthi needs no sound_index, 0 is a dummy value
-            self.piano = Synthesizer(self, 0)  
-        else:
-            self.piano = Piano(self, piano_index)
-
-
-class Instrument:
-    sounds = []
-    sound_index = 0
-
-    def __init__(self, sound_index):
-        self.sound_index = sound_index
-        self.load_sounds()
-
-    def load_sounds(self):
-        sounds_path = glob.glob(os.path.join(SOUND_BASEDIR, 
-                                                   sound_sets[self.sound_index], "*.wav"))
-        sounds_path.sort(key=natural_sort_key)
-        self.sounds = [pygame.mixer.Sound(f) for f in sounds_path]  
-
-
-class Drums(Instrument):
-
-    def __init__(self, sound_index):
-        super(Drums, self).__init__(sound_index)
-
-        drumhat.on_hit(drumhat.PADS, self.handle_hit)
-        drumhat.on_release(drumhat.PADS, self.handle_release)
-
-    def handle_hit(self, event):
-        # event.channel is a zero based channel index for each pad
-        self.sounds[event.channel].play(loops=0)
-
-    def handle_release(self):
-        pass  
-
-
-# maybe add a wrapper four outputting played sound  filename?
-class Piano(Instrument):
-    octave = 0
-    octaves = 0 
-    container = None
-    mixer_settings = MIXER_NORMAL
-
-    def __init__(self, container, sound_index):
-        super(Piano, self).__init__(sound_index)
-
-        self.container = container
-
-        pianohat.on_note(self.handle_note)
-        pianohat.on_octave_up(self.handle_octave_up)
-        pianohat.on_octave_down(self.handle_octave_down)
-        pianohat.on_instrument(self.handle_instrument)
-
-        pianohat.auto_leds(True)
-
-    def load_sounds(self):
-        set_mixer(self.mixer_settings)  # reset mixer to normal mode
-
-        super(Piano, self).load_sounds()        
-        self.octaves = len(self.sounds) / 12
-        self.octave = int(self.octaves / 2)   
-
-    # could be merged with handle_hit in Drum, but that'd be obfuscating
-    def handle_note(self, channel, pressed):
-        channel = channel + (12 * self.octave)
-
-        if channel < len(self.sounds) and pressed:
-            self.sounds[channel].play(loops=0)
-
-    def handle_instrument(self, channel, pressed):
-        if pressed:
-            self.sound_index = (self.sound_index + 1) % len(sound_sets)
-            self.container.create_piano(self.sound_index)
-
-    def handle_octave_up(self, channel, pressed):
-        if pressed and self.octave < int(self.octaves) - 1:
-            self.octave += 1
-
-    def handle_octave_down(self, channel, pressed):
-        if pressed and self.octave > 0:
-            self.octave -= 1
-
-
-class Synthesizer(Piano):
-    mixer_settings = MIXER_8BIT
-    wavetype_index = 0
-
-    def __init__(self, container, sound_index):
-        super(Synthesizer, self).__init__(container,  sound_index)   
-
-    def handle_note(self, channel, pressed):
-        """Handles the piano keys
-        Any enabled samples are played, and *all* samples are turned off is a key is released
-        """
-        
-        if pressed:
-            # 'tis so ugly
-            for i in range(3):
-                if LEGAL_WAVES[self.wavetype_index][i]:
-                    notes[wavetypes[i]][channel].play(loops=-1, fade_ms=ATTACK_MS)
-        else:
-            for t in wavetypes:
-                notes[t][channel].fadeout(RELEASE_MS)
-
-    def handle_octave_up(self, channel, pressed):
-        if pressed and self.wavetype_index < len(LEGAL_WAVES) - 1:
-            self.wavetype_index += 1
-
-    def handle_octave_down(self, channel, pressed):
-        if pressed and self.wavetype_index > 0:
-            self.wavetype_index -= 1
-
-
-def turn_off(pin):
-    """ Shutdown the Raspberry Pi; the argument pin is not required
-    but passed by event_detect. """
-
-    GPIO.cleanup()
-    subprocess.call(['sudo poweroff'], shell=True)
+    parser.add_argument('-b', '--buffer', type=int, default=instruments.BUFFER_SIZE,
+                        help='mixer buffer size in samples (default: %(default)s)')
+    parser.add_argument('-r', '--samplerate', type=int, default=instruments.SAMPLERATE,
+                        help='mixer sample rate in Hz (default: %(default)s)')
+    parser.add_argument('-c', '--channels', type=int, default=instruments.CHANNELS,
+                        help='number of sounds that can play at once (default: %(default)s)')
+    parser.add_argument('--backend', choices=['pygame', 'numpy'], default='pygame',
+                        help='mix with pygame or with the numpy engine (default: %(default)s)')
+    parser.add_argument('--sink', default='aplay',
+                        help='output of the numpy engine: aplay, null or a .wav file (default: %(default)s)')
+    parser.add_argument('--sound-memory', type=int, default=soundsets.MAX_BYTES // 2**20,
+                        help='MB of decoded sound sets kept in memory (default: %(default)s)')
+    parser.add_argument('--stream-memory', type=int, default=streaming.MAX_CHUNK_BYTES // 2**20,
+                        help='MB of streamed chunks kept for playing them again (default: %(default)s)')
+    parser.add_argument('--midi',
+                        help='send the notes to MIDI as well: alsa (a running yoshimi or SunVox), '
+                             'the name of an ALSA client, loopback or a file')
+    parser.add_argument('--midi-only', action='store_true',
+                        help='with --midi, don\'t play the samples')
+    parser.add_argument('--synth-range', type=int, nargs=2, metavar=('LOW', 'HIGH'),
+                        default=instruments.SYNTH_RANGE,
+                        help='MIDI notes the 8bit synth covers (default: %(default)s)')
+    parser.add_argument('--record',
+                        help='append every touch event to this file, render it with render.py')
+    parser.add_argument('--loop', type=float, metavar='BPM',
+                        help='loop the pads and keys played from the first hit on at this tempo')
+    parser.add_argument('--loop-bars', type=int, default=1,
+                        help='bars of 4 beats in a loop (default: %(default)s)')
+    parser.add_argument('--loop-layers', type=int, default=1,
+                        help='loops recorded one after the other and played together '
+                             '(default: %(default)s)')
+    parser.add_argument('--measure-latency', action='store_true',
+                        help='report the latency of each buffer size of pygame\'s mixer and exit')
+    parser.add_argument('--simulate', action='store_true',
+                        help='play random touch events instead of using the HATs')
+    parser.add_argument('--script',
+                        help='with --simulate, replay the events of this file instead')
+    parser.add_argument('--event-rate', type=float, default=10.0,
+                        help='random events per second for --simulate (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds of random events for --simulate (default: %(default)s)')
+    parser.add_argument('--stats-file',
+                        help='write timings and voice counters as JSON to this file periodically')
+    parser.add_argument('--stats-interval', type=float, default=10.0,
+                        help='seconds between two writes of --stats-file (default: %(default)s)')
+    parser.add_argument('--stats-socket',
+                        help='answer connections to this Unix socket with the current stats')
+
+    args = parser.parse_args(sysargs)
+
+    if args.channels < 2:
+        parser.error('--channels needs 2 at least, one for the drums and one for the piano')
+
+    low, high = args.synth_range
+    if low < 0 or high > 127 or high - low < 12:
+        # the keys of the Piano HAT span an octave
+        parser.error('--synth-range needs 0 <= LOW, HIGH <= 127 and at least 12 notes between them')
+
+    return args
+
+
+def measure_latency(samplerate, channels, repeat=200):
+    """ Prints the theoretical buffer latency and the measured time from
+    entering a callback until play() returned for every buffer size. """
+
+    print('buffer   rate  buffer latency  play() median  play() max')
+    for buffer_size in BUFFER_SIZES:
+        pygame.mixer.quit()
+        instruments.init_mixer(samplerate, buffer_size, channels)
+        rate = pygame.mixer.get_init()[0]
+        sound = instruments.notes.get(('sine',), 0).sustain
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            instruments.allocator.play('drums', sound)
+            timings.append(time.perf_counter() - start)
+            time.sleep(0.002)
+        pygame.mixer.stop()
+
+        timings.sort()
+        print('{:6d} {:6d} {:12.2f} ms {:10.3f} ms {:8.3f} ms'.format(
+            buffer_size, rate, 1000.0 * buffer_size / rate,
+            1000 * timings[len(timings) // 2], 1000 * timings[-1]))
+
+
+def enable_stats(args, loops):
+    """ Times the hot paths and exposes the results; must happen before the
+    mixer and instruments are created. """
+
+    timings = stats.Stats()
+    timings.instrument(instruments.Drums, ['handle_hit'])
+    timings.instrument(instruments.Piano, ['handle_note', 'load_sounds'])
+    timings.instrument(instruments.Synthesizer, ['handle_note'])
+    timings.instrument(instruments.Container, ['create_piano'])
+    timings.instrument(instruments, ['init_mixer'])
+    timings.instrument(soundsets.SoundSetRegistry, ['decode'])
+
+    timings.gauge('active_voices', lambda: instruments.allocator.active_voices())
+    timings.gauge('voices', lambda: dict(instruments.allocator.counters))
+    timings.gauge('synth_memory', lambda: instruments.notes.memory())
+    timings.gauge('stream_memory', lambda: instruments.registry.chunks.memory())
+    if instruments.midi_out is not None:
+        timings.gauge('midi', lambda: instruments.midi_out.snapshot())
+    if loops is not None:
+        timings.gauge('looper', loops.snapshot)
+
+    if args.stats_file:
+        timings.dump_periodically(args.stats_file, args.stats_interval)
+    if args.stats_socket:
+        try:
+            timings.serve(args.stats_socket)
+        except ValueError as e:
+            sys.exit(e)
+
+    return timings
+
+
+def midi_output(name):
+    """ Returns the MIDI output --midi names. """
+
+    if name == 'loopback':
+        return midiout.LoopbackOutput()
+    if name == 'alsa' or '/' not in name and '.' not in name:
+        found = midiout.find_client(midiout.SUPPORTED_CLIENTS if name == 'alsa' else [name])
+        if found is None:
+            sys.exit('{} is not running'.format(name))
+        print('Connecting to {}'.format(found[0]))
+        return midiout.AlsaOutput(found[1])
+    return midiout.FileOutput(name)
+
+
+def report_startup(phases):
+    """ Prints how long each phase of the startup took; the sets and synth
+    banks are timed on the worker threads, so they overlap. """
+
+    for name, seconds in sorted(instruments.registry.timings.items()):
+        phases.append(('decode ' + name, seconds))
+    for name, seconds in sorted(instruments.notes.timings.items()):
+        phases.append(('synth ' + name, seconds))
+
+    print('startup: ' + ', '.join('{} {:.0f} ms'.format(name, 1000 * seconds)
+                                  for name, seconds in phases))
+
+
+def simulate(hat, args, loops):
+    """ Replays touch events and reports how fast they were queued and how
+    long they waited for the dispatch thread and its handlers took. """
+
+    if args.script:
+        script = hardware.load_script(args.script)
+    else:
+        script = hardware.random_script(args.event_rate, args.duration)
+
+    hat.replay(script)
+    # the handlers of the queued events, the loops queue no more
+    if loops is not None:
+        loops.stop()
+    hat.stop()
+
+    # the callbacks only queue, the handlers run on the dispatch thread
+    callback_times = sorted(hat.callback_times) or [0.0]
+    latencies = sorted(hat.latencies) or [0.0]
+    print('{} events, queueing median {:.3f} ms, max {:.3f} ms, latest {:.3f} ms'.format(
+        hat.events, 1000 * callback_times[len(callback_times) // 2],
+        1000 * callback_times[-1], 1000 * latencies[-1]))
+    print('handlers: waited mean {:.3f} ms, max {:.3f} ms, ran mean {:.3f} ms, max {:.3f} ms'.format(
+        1000 * hat.waited.total / max(hat.waited.count, 1), 1000 * hat.waited.max,
+        1000 * hat.handled.total / max(hat.handled.count, 1), 1000 * hat.handled.max))
+    print('dispatch: {}'.format(hat.snapshot()))
+    print('voices: {}'.format(instruments.allocator.counters))
+    print('synth memory: {}'.format(instruments.notes.memory()))
+    if instruments.midi_out is not None:
+        print('midi: {}'.format(instruments.midi_out.snapshot()))
+    if loops is not None:
+        print('looper: {}'.format(loops.snapshot()))
 
 
 if __name__ == "__main__":
-    # optional shutdown button
-    GPIO.add_event_detect(24, edge=GPIO.FALLING, callback=turn_off) 
-    args = parse_arguments(sys.argv[1:]) 
-
-    container = Container(sound_sets.index(args.piano), sound_sets.index(args.drums))
+    args = parse_arguments(sys.argv[1:])
+
+    if args.measure_latency:
+        measure_latency(args.samplerate, args.channels)
+        sys.exit()
+
+    if args.simulate:
+        hat = hardware.SimulatedBackend()
+    else:
+        hat = hardware.HatBackend()
+        # optional shutdown button
+        hat.enable_shutdown_button()
+
+    if args.midi:
+        sender = midiout.MidiSender(midi_output(args.midi))
+        sender.start()
+        instruments.init_midi(sender, args.midi_only)
+
+    loops = None
+    if args.loop:
+        loops = looper.Looper(args.loop, args.loop_bars, args.loop_layers)
+
+    statistics = None
+    if args.stats_file or args.stats_socket:
+        statistics = enable_stats(args, loops)
+
+    instruments.registry.max_bytes = args.sound_memory * 2**20
+    instruments.registry.chunks.max_bytes = args.stream_memory * 2**20
+
+    start = time.perf_counter()
+    instruments.init_mixer(args.samplerate, args.buffer, args.channels, args.backend, args.sink,
+                           args.synth_range)
+    mixer_ready = time.perf_counter()
+
+    session = None
+    if args.record:
+        session = recorder.Recorder(args.record, {
+            'piano': args.piano, 'drums': args.drums, 'samplerate': pygame.mixer.get_init()[0],
+            'channels': args.channels, 'synth_range': list(args.synth_range)})
+        hat = recorder.RecordingBackend(hat, session)
+    if loops is not None:
+        hat = recorder.RecordingBackend(hat, loops)
+
+    # the HAT callbacks only queue the events, recorded with their real times
+    hat = dispatch.DispatchBackend(hat)
+    if statistics is not None:
+        statistics.gauge('dispatch', hat.snapshot)
+
+    try:
+        container = instruments.Container(instruments.sound_sets.index(args.piano),
+                                          instruments.sound_sets.index(args.drums), hat)
+        if loops is not None:
+            loops.start(hat)
+        ready = time.perf_counter()
+        report_startup([('mixer', mixer_ready - start), ('instruments', ready - mixer_ready),
+                        ('total', ready - start)])
+        if args.simulate:
+            hat.start()
+            simulate(hat, args, loops)
+        else:
+            hat.run()
+    finally:
+        # the looper queues events for the dispatch thread
+        if loops is not None:
+            loops.stop()
+        hat.stop()
+        if args.backend == 'numpy':
+            instruments.allocator.stop()  # finishes the .wav file of a file sink
+        if instruments.midi_out is not None:
+            instruments.midi_out.stop()
+        if session is not None:
+            session.close()
@@ -0,0 +1,80 @@
+""" A small scheduler: callbacks run at absolute monotonic times on one
+background thread, so input handlers can hand work off instead of
+sleeping. """
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+LATENESS_SAMPLES = 10000
+
+
+class Scheduler:
+    """ Runs callbacks in the order of their due time; callbacks that are
+    due at the same time run in the order they were scheduled. """
+
+    def __init__(self):
+        # (due, sequence number, callback, args), the next one first
+        self.queue = []
+        self.counter = itertools.count()
+        self.cancelled = set()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # seconds the latest callbacks ran after their due time
+        self.lateness = collections.deque(maxlen=LATENESS_SAMPLES)
+
+    def call_at(self, when, callback, *args):
+        """Runs callback(*args) at the time.monotonic() time when, returns
+        a handle for cancel"""
+
+        with self.condition:
+            entry = (when, next(self.counter), callback, args)
+            heapq.heappush(self.queue, entry)
+            if self.queue[0] is entry:
+                self.condition.notify()
+
+        return entry[1]
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(time.monotonic(), callback, *args)
+
+    def cancel(self, handle):
+        with self.condition:
+            self.cancelled.add(handle)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+
+                when, handle, callback, args = heapq.heappop(self.queue)
+                if handle in self.cancelled:
+                    self.cancelled.discard(handle)
+                    continue
+
+            self.lateness.append(time.monotonic() - when)
+            callback(*args)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
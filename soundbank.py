@@ -0,0 +1,143 @@
+""" Packed sound banks: all sounds of a set in one file, already converted
+into the mixer's format. The file starts with a JSON index of the sounds
+followed by one contiguous blob of 16 bit samples, which is memory-mapped
+and sliced instead of parsing and converting every .wav file. Identical
+sounds are stored once and share their entry's offset. """
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import numpy
+import pygame
+
+import streaming
+
+MAGIC = b'RPIBANK1'
+# 2 added the sources
+VERSION = 2
+
+# the samples start at a multiple of this, for aligned access
+ALIGNMENT = 16
+
+
+def bank_path(basedir, name):
+    return os.path.join(basedir, name, name + '.bank')
+
+
+def sources(directory):
+    """Returns the name, size and modification time of every .wav file of a
+    set directory, which a bank has to match to be used"""
+
+    files = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.wav'))):
+        st = os.stat(path)
+        files.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+    return files
+
+
+def pack(directory, sort_key=None):
+    """Decodes the .wav files of a set directory into the current mixer
+    format and writes them into a bank, returns its path"""
+
+    name = os.path.basename(os.path.normpath(directory))
+    paths = glob.glob(os.path.join(directory, '*.wav'))
+    paths.sort(key=sort_key)
+
+    frequency, size, channels = pygame.mixer.get_init()
+    if size != -16:
+        raise ValueError('banks hold signed 16 bit samples, the mixer uses {}'.format(size))
+
+    sounds = []
+    blobs = []
+    # digest of the samples -> their offset
+    offsets = {}
+    offset = 0
+    for note, path in enumerate(paths):
+        samples = pygame.sndarray.array(pygame.mixer.Sound(path))
+        blob = samples.astype('<i2').tobytes()
+        digest = hashlib.sha1(blob).digest()
+        if digest not in offsets:
+            offsets[digest] = offset
+            blobs.append(blob)
+            offset += len(samples) * channels
+
+        sounds.append({'name': os.path.basename(path), 'note': note,
+                       'offset': offsets[digest], 'length': len(samples)})
+
+    index = json.dumps({'version': VERSION, 'samplerate': frequency, 'channels': channels,
+                        'sources': sources(directory), 'sounds': sounds}).encode()
+    header_size = len(MAGIC) + 4 + len(index)
+    padding = -header_size % ALIGNMENT
+
+    path = bank_path(os.path.dirname(os.path.normpath(directory)), name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(index) + padding))
+        f.write(index + b' ' * padding)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def read_index(data):
+    """Returns the index of a bank and where its samples start"""
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a sound bank')
+
+    start = len(MAGIC) + 4
+    index_size = struct.unpack('<I', data[len(MAGIC):start])[0]
+    index = json.loads(data[start:start + index_size].decode())
+    if index['version'] != VERSION:
+        raise ValueError('bank version {} is not supported, run pack.py again'.format(
+            index['version']))
+
+    return index, start + index_size
+
+
+def load(path, cache, arrays=False):
+    """Returns the file names and the sounds of a bank packed for the
+    current mixer format; with arrays, the samples are returned as numpy
+    slices of the mapped file, which engine.SoftwareMixer plays without
+    copying them. Long sounds are streamed from the mapped file otherwise."""
+
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    index, data_offset = read_index(data)
+    frequency, _, channels = pygame.mixer.get_init()
+    if (index['samplerate'], index['channels']) != (frequency, channels):
+        raise ValueError('{} was packed for {} Hz and {} channels'.format(
+            path, index['samplerate'], index['channels']))
+    if index['sources'] != sources(os.path.dirname(path)):
+        raise ValueError('the .wav files of {} changed since it was packed, run pack.py again'.format(
+            path))
+
+    blob = numpy.frombuffer(data, dtype='<i2', offset=data_offset)
+
+    entries = sorted(index['sounds'], key=lambda entry: entry['note'])
+    # offset -> sound, entries with the same samples share the sound
+    shared = {}
+    for entry in entries:
+        if entry['offset'] in shared:
+            continue
+
+        samples = blob[entry['offset']:entry['offset'] + entry['length'] * channels]
+        frames = samples.reshape(entry['length'], channels)
+
+        if arrays:
+            shared[entry['offset']] = frames[:, 0]
+        elif entry['length'] >= streaming.STREAM_MIN_S * frequency:
+            shared[entry['offset']] = streaming.StreamedSound(frames, frequency, cache)
+        else:
+            shared[entry['offset']] = pygame.mixer.Sound(buffer=samples)
+
+    return ([entry['name'] for entry in entries],
+            [shared[entry['offset']] for entry in entries])
@@ -0,0 +1,213 @@
+""" Registry of decoded sound sets, so switching instruments only swaps
+references instead of decoding every .wav file again. """
+
+import collections
+import glob
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy
+import pygame
+
+import soundbank
+import streaming
+
+# upper limit for the decoded sounds kept in memory, of streamed sounds
+# only their attack counts
+MAX_BYTES = 64 * 1024 * 1024
+
+# MIDI velocities, the index of a pad's velocity table
+VELOCITIES = 128
+
+# <pad>[_v<layer>][_rr<alternate>].wav, e.g. 006_snare_v2_rr1.wav
+LAYER_PATTERN = re.compile(r'^(?P<pad>.*?)(?:_v(?P<layer>[0-9]+))?(?:_rr(?P<alternate>[0-9]+))?$')
+
+
+def natural_sort_key(s, _nsre=re.compile('([0-9]+)')):
+    return [int(text) if text.isdigit() else text.lower() for text in re.split(_nsre, s)]
+
+
+def sound_bytes(sound):
+    """Estimates the memory used by a sound in the current mixer format"""
+
+    if isinstance(sound, numpy.ndarray):
+        return sound.nbytes
+    if isinstance(sound, streaming.StreamedSound):
+        sound = sound.attack
+
+    frequency, size, channels = pygame.mixer.get_init()
+    return int(sound.get_length() * frequency) * (abs(size) // 8) * channels
+
+
+def sound_data(sound):
+    """Returns the samples of a sound as bytes, None for streamed sounds"""
+
+    if isinstance(sound, numpy.ndarray):
+        return sound.tobytes()
+    if isinstance(sound, streaming.StreamedSound):
+        return None
+    return sound.get_raw()
+
+
+def deduplicate(sounds):
+    """Replaces sounds with identical samples by the first of them, so
+    alternates that are copies share one buffer"""
+
+    seen = {}
+    unique = []
+    for sound in sounds:
+        data = sound_data(sound)
+        if data is not None:
+            digest = hashlib.sha1(data).digest()
+            sound = seen.setdefault((digest, len(data)), sound)
+        unique.append(sound)
+
+    return unique
+
+
+class RoundRobin:
+    """ The alternates of a velocity layer, played in turn. """
+
+    __slots__ = ('sounds', 'index')
+
+    def __init__(self, sounds):
+        self.sounds = sounds
+        self.index = 0
+
+    def next(self):
+        sound = self.sounds[self.index]
+        self.index = (self.index + 1) % len(self.sounds)
+        return sound
+
+
+def velocity_table(names, sounds):
+    """Groups the sounds of a set by their file names into pads and returns
+    one table per pad that maps every velocity to its layer's RoundRobin;
+    the layers split the velocities evenly, the softest first"""
+
+    pads = collections.OrderedDict()
+    for filename, sound in zip(names, sounds):
+        match = LAYER_PATTERN.match(os.path.splitext(filename)[0])
+        layer = int(match.group('layer') or 0)
+        alternate = int(match.group('alternate') or 0)
+        pads.setdefault(match.group('pad'), {}).setdefault(layer, []).append((alternate, sound))
+
+    tables = []
+    for layers in pads.values():
+        robins = [RoundRobin([sound for _, sound in sorted(layers[layer], key=lambda a: a[0])])
+                  for layer in sorted(layers)]
+        tables.append([robins[velocity * len(robins) // VELOCITIES]
+                       for velocity in range(VELOCITIES)])
+
+    return tables
+
+
+class SoundSetRegistry:
+    """ Decodes each sound set once per mixer format and keeps the least
+    recently used sets up to max_bytes. Long files are streamed, their
+    chunks are cached up to stream_bytes. A packed bank of a set is
+    preferred over its .wav files, which are decoded on the executor, if
+    one is given. """
+
+    def __init__(self, basedir, max_bytes=MAX_BYTES, stream_bytes=streaming.MAX_CHUNK_BYTES,
+                 executor=None):
+        self.basedir = basedir
+        self.max_bytes = max_bytes
+        self.chunks = streaming.ChunkCache(stream_bytes)
+        self.executor = executor
+        # return the sounds of banks as numpy arrays, for engine.SoftwareMixer
+        self.arrays = False
+
+        # set name -> seconds its last decode took
+        self.timings = {}
+        # set name -> file names of its sounds, in the same order
+        self.names = {}
+
+        # (set name, mixer format) -> (sounds, bytes), oldest first
+        self.sets = collections.OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        """Returns the sounds of a set, decoding them if they are not cached"""
+
+        key = (name, pygame.mixer.get_init())
+
+        with self.lock:
+            if key in self.sets:
+                self.sets.move_to_end(key)
+                return self.sets[key][0]
+
+            # another thread is decoding this set already, wait for it
+            done = self.loading.get(key)
+            if done is None:
+                self.loading[key] = threading.Event()
+
+        if done is not None:
+            done.wait()
+            return self.get(name)
+
+        try:
+            sounds = self.decode(name)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+        # shared buffers count once
+        unique = {id(sound): sound for sound in sounds}.values()
+        with self.lock:
+            self.sets[key] = (sounds, sum(sound_bytes(s) for s in unique))
+            self.evict(keep=key)
+
+        return sounds
+
+    def decode(self, name):
+        start = time.perf_counter()
+
+        bank_path = soundbank.bank_path(self.basedir, name)
+        if os.path.exists(bank_path):
+            try:
+                self.names[name], sounds = soundbank.load(bank_path, self.chunks, self.arrays)
+                self.timings[name] = time.perf_counter() - start
+                return sounds
+            except ValueError as e:
+                print('{}; decoding the .wav files instead'.format(e))
+
+        sounds_path = glob.glob(os.path.join(self.basedir, name, "*.wav"))
+        sounds_path.sort(key=natural_sort_key)
+
+        if self.executor is None:
+            sounds = [streaming.load(f, self.chunks) for f in sounds_path]
+        else:
+            # pygame and numpy release the GIL while decoding and converting
+            sounds = list(self.executor.map(lambda f: streaming.load(f, self.chunks),
+                                            sounds_path))
+        sounds = deduplicate(sounds)
+        self.names[name] = [os.path.basename(f) for f in sounds_path]
+        self.timings[name] = time.perf_counter() - start
+
+        return sounds
+
+    def evict(self, keep):
+        """Drops the least recently used sets until the cap is met"""
+
+        used = sum(size for _, size in self.sets.values())
+        for key in list(self.sets):
+            if used <= self.max_bytes:
+                break
+            if key != keep:
+                used -= self.sets.pop(key)[1]
+
+    def preload(self, name):
+        """Decodes a set in a background thread, e.g. the next instrument"""
+
+        def load():
+            try:
+                self.get(name)
+            except pygame.error:
+                pass  # the mixer was reset meanwhile, the set is decoded on use
+
+        threading.Thread(target=load, daemon=True).start()
@@ -0,0 +1,132 @@
+""" Opt-in instrumentation of the hot paths: counters, latency histograms
+and gauges, exposed as a periodic JSON dump or on a Unix socket. Nothing
+is wrapped unless Stats.instrument is called, so there is no overhead
+when it is disabled. """
+
+import functools
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+
+# histogram buckets are powers of two in microseconds, up to about 1 s
+BUCKETS = 21
+
+
+class Histogram:
+    """ Call count, total, maximum and a log2 histogram of durations. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+                'max_ms': 1000 * self.max,
+                # upper bound of the bucket in microseconds -> calls
+                'buckets_us': {str(2**i): n for i, n in enumerate(self.buckets) if n}}
+
+
+class Stats:
+    """ Timings of the instrumented functions and the values of gauges. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def gauge(self, name, function):
+        """Adds the return value of function to every snapshot"""
+
+        self.gauges[name] = function
+
+    def wrap(self, function, name):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return timed
+
+    def instrument(self, owner, names):
+        """Replaces the functions or methods names of a module or class by
+        timed wrappers; must happen before callbacks are registered"""
+
+        for name in names:
+            setattr(owner, name, self.wrap(getattr(owner, name),
+                                           '{}.{}'.format(owner.__name__, name)))
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {name: h.snapshot() for name, h in self.histograms.items()}
+
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:  # a gauge must never take the stats down
+                gauges[name] = repr(e)
+
+        return {'uptime_s': time.time() - self.started,
+                'timings': histograms,
+                'gauges': gauges}
+
+    def dump(self, path):
+        """Writes a snapshot as JSON, atomically"""
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def dump_periodically(self, path, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def serve(self, path):
+        """Answers every connection to the Unix socket at path with a
+        snapshot, e.g. socat - UNIX-CONNECT:path"""
+
+        stats = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(json.dumps(stats.snapshot(), sort_keys=True).encode() + b'\n')
+
+        # a socket left behind by an earlier run is replaced, anything else kept
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ValueError('{} exists and is not a socket'.format(path))
+            os.remove(path)
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
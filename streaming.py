@@ -0,0 +1,234 @@
+""" Streaming of long .wav files: the sample data is memory-mapped instead of
+decoded, only the attack of each sound is kept as a pygame sound and the
+rest is cut into chunks on demand, which are queued on the playing channel
+one after another. """
+
+import collections
+import mmap
+import struct
+import threading
+import time
+
+import numpy
+import pygame
+
+# files shorter than this are decoded completely
+STREAM_MIN_S = 2.0
+# the part of a streamed sound that stays in memory
+ATTACK_S = 0.3
+CHUNK_S = 0.25
+# upper limit for the chunks kept for playing them again
+MAX_CHUNK_BYTES = 16 * 1024 * 1024
+
+# the next chunk is queued this often
+POLL_S = 0.02
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class WaveFile:
+    """ The frames of a 16 bit PCM .wav file as a memory-mapped numpy array
+    of shape (frames, channels); the pages are read by the kernel when
+    they are first touched. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != b'RIFF' or self.map[8:12] != b'WAVE':
+            raise ValueError('{} is no .wav file'.format(path))
+
+        fmt = data = None
+        position = 12
+        while position + 8 <= len(self.map):
+            chunk_id = self.map[position:position + 4]
+            size = struct.unpack('<I', self.map[position + 4:position + 8])[0]
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', self.map[position + 8:position + 24])
+            elif chunk_id == b'data':
+                data = (position + 8, min(size, len(self.map) - position - 8))
+            position += 8 + size + (size & 1)
+
+        if fmt is None or data is None:
+            raise ValueError('{} has no fmt or data chunk'.format(path))
+
+        tag, self.channels, self.samplerate, _, _, bits = fmt
+        if tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) or bits != 16:
+            raise ValueError('{} is not 16 bit PCM'.format(path))
+
+        offset, size = data
+        frames = size // (2 * self.channels)
+        self.frames = numpy.frombuffer(self.map, dtype='<i2', count=frames * self.channels,
+                                       offset=offset).reshape(frames, self.channels)
+
+    def duration(self):
+        return len(self.frames) / float(self.samplerate)
+
+
+def convert(frames, samplerate, start, count):
+    """Returns count samples of the mixer format from position start (in
+    mixer samples) on; mixes the channels down and resamples linearly"""
+
+    frequency, _, channels = pygame.mixer.get_init()
+    step = samplerate / float(frequency)
+
+    positions = (start + numpy.arange(count)) * step
+    first = int(positions[0])
+    last = min(len(frames), int(positions[-1]) + 2)
+    mono = frames[first:last].mean(axis=1, dtype=numpy.float32)
+    wide = numpy.interp(positions, numpy.arange(first, last), mono)
+    wide = numpy.round(wide).astype(numpy.int16)
+    if channels == 1:
+        return wide
+
+    out = numpy.empty((count, channels), dtype=numpy.int16)
+    out[:] = wide[:, numpy.newaxis]
+    return out
+
+
+class ChunkCache:
+    """ The least recently played chunks of all streamed sounds, up to
+    max_bytes. """
+
+    def __init__(self, max_bytes=MAX_CHUNK_BYTES):
+        self.max_bytes = max_bytes
+        # (sound, index) -> (pygame sound, bytes), oldest first
+        self.chunks = collections.OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, sound, index):
+        key = (sound, index)
+        with self.lock:
+            entry = self.chunks.get(key)
+            if entry is not None:
+                self.chunks.move_to_end(key)
+                return entry[0]
+
+        samples = sound.samples(index)
+        chunk = pygame.sndarray.make_sound(samples)
+
+        with self.lock:
+            self.chunks[key] = (chunk, samples.nbytes)
+            self.used_bytes += samples.nbytes
+            while self.used_bytes > self.max_bytes and len(self.chunks) > 1:
+                _, (_, size) = self.chunks.popitem(last=False)
+                self.used_bytes -= size
+
+        return chunk
+
+    def memory(self):
+        return {'chunks': len(self.chunks), 'bytes': self.used_bytes,
+                'max_bytes': self.max_bytes}
+
+
+class StreamedSound:
+    """ A long sound: the attack is a resident pygame sound, the chunks
+    after it are made from the memory-mapped frames by the cache. """
+
+    def __init__(self, frames, samplerate, cache):
+        self.frames = frames
+        self.samplerate = samplerate
+        self.cache = cache
+
+        frequency = pygame.mixer.get_init()[0]
+        self.length = len(frames) * frequency // samplerate
+        self.attack_length = min(self.length, int(ATTACK_S * frequency))
+        self.chunk_length = int(CHUNK_S * frequency)
+
+        self.attack = pygame.sndarray.make_sound(
+            convert(frames, samplerate, 0, self.attack_length))
+
+    def __len__(self):
+        """Returns the number of chunks after the attack"""
+
+        return -(-(self.length - self.attack_length) // self.chunk_length)
+
+    def samples(self, index):
+        start = self.attack_length + index * self.chunk_length
+        count = min(self.chunk_length, self.length - start)
+        return convert(self.frames, self.samplerate, start, count)
+
+    def chunk(self, index):
+        return self.cache.get(self, index)
+
+    def get_length(self):
+        return self.length / float(pygame.mixer.get_init()[0])
+
+
+def load(path, cache):
+    """Returns a StreamedSound for long 16 bit .wav files and a decoded
+    pygame sound for everything else"""
+
+    try:
+        wavefile = WaveFile(path)
+    except (OSError, ValueError):
+        return pygame.mixer.Sound(path)
+
+    if wavefile.duration() < STREAM_MIN_S:
+        return pygame.mixer.Sound(path)
+
+    return StreamedSound(wavefile.frames, wavefile.samplerate, cache)
+
+
+class Streamer:
+    """ Plays the attack of streamed sounds and keeps queueing their chunks
+    from a thread while the voice plays them; a voice that is stolen or
+    stopped ends its stream. """
+
+    def __init__(self):
+        # voice -> [sound, index of the next chunk, the last sound handed to the voice]
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def play(self, allocator, pool_name, sound):
+        """Starts a streamed sound on a voice of the pool, like allocator.play"""
+
+        voice = allocator.play(pool_name, sound.attack)
+        if voice is not None and len(sound):
+            with self.lock:
+                self.streams[voice] = [sound, 0, sound.attack]
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+
+        return voice
+
+    def run(self):
+        while True:
+            time.sleep(POLL_S)
+            self.poll()
+
+    def poll(self):
+        """Queues the next chunk of every stream that needs one"""
+
+        with self.lock:
+            streams = list(self.streams.items())
+
+        for voice, stream in streams:
+            self.feed(voice, stream)
+
+    def feed(self, voice, stream):
+        sound, index, pending = stream
+        playing, queued = voice.get_sound(), voice.get_queue()
+
+        if queued is pending:
+            return  # still playing the sound before, or fading out a stolen one
+
+        if playing is not pending or queued is not None:
+            # stolen, stopped or too late
+            self.end(voice, stream)
+            return
+
+        chunk = sound.chunk(index)
+        voice.queue(chunk)
+        stream[1:] = [index + 1, chunk]
+        if index + 1 == len(sound):
+            self.end(voice, stream)
+
+    def end(self, voice, stream):
+        with self.lock:
+            if self.streams.get(voice) is stream:
+                del self.streams[voice]
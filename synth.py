@@ -0,0 +1,462 @@
+""" Waveform engine for the 8-bit synthesizer: whole sample buffers are
+computed as numpy arrays instead of one sample at a time. """
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+
+import numpy
+
+SAMPLERATE = 44100
+BITRATE = 8
+
+# generated sample banks are stored here and reused on the next start
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache/")
+
+# bump when the generated buffers change, so stale caches are not loaded
+GENERATOR_VERSION = 2
+
+# samples per period of a band-limited wavetable
+TABLE_SIZE = 2048
+
+# the wavetables are mipmapped per octave above this frequency
+BASE_FREQUENCY = 32.703  # C1
+
+# a loop holds up to this many periods, so its length in whole samples
+# matches the true frequency closely
+MAX_PERIODS = 32
+MAX_DETUNE_CENTS = 0.5
+
+# upper limit for the built synth sounds kept in memory
+MAX_BYTES = 16 * 1024 * 1024
+
+# equal temperament frequency of every MIDI note, A4 (note 69) is 440 Hz
+MIDI_FREQUENCIES = 440.0 * 2**((numpy.arange(128) - 69) / 12.0)
+
+# one octave from middle C, one frequency per piano HAT key
+FREQUENCIES = [
+    261.626,
+    277.183,
+    293.665,
+    311.127,
+    329.628,
+    349.228,
+    369.994,
+    391.995,
+    415.305,
+    440.000,
+    466.164,
+    493.883,
+    523.251
+]
+
+
+# The samples are 8bit signed, from -127 to +127
+# so the max amplitude of a sample is 127
+max_sample = 2**(BITRATE - 1) - 1
+
+
+def note_frequencies(low, high):
+    """Returns the frequencies of the MIDI notes low to high, inclusive"""
+
+    return MIDI_FREQUENCIES[low:high + 1]
+
+
+def time_axis(sample_count, samplerate=SAMPLERATE):
+    """Returns the time index of every sample in a buffer"""
+
+    return numpy.arange(sample_count) / samplerate
+
+
+def wave_sine(freq, time):
+    """Generates sine wave samples for an array of time indices"""
+
+    s = numpy.sin(2*numpy.pi*freq*time)
+    return numpy.round(max_sample * s)
+
+
+def wave_square(freq, time):
+    """Generates square wave samples for an array of time indices"""
+
+    return numpy.where(freq*time < 0.5, -max_sample, max_sample)
+
+
+def wave_saw(freq, time):
+    """Generates saw wave samples for an array of time indices"""
+
+    s = ((freq*time)*2) - 1
+    return numpy.round(max_sample * s)
+
+
+WAVETYPES = ['sine', 'saw', 'square']
+
+
+def generate_buffer(frequency, wavetype=None, samplerate=SAMPLERATE):
+    """Generates one period of a specific frequency and wavetype as a
+    stereo int8 buffer"""
+    if wavetype is None:
+        wavetype = wave_square
+
+    sample_count = int(round(samplerate/frequency))
+
+    mono = wavetype(frequency, time_axis(sample_count, samplerate))
+
+    # broadcast the mono wave onto both stereo channels
+    buf = numpy.empty((sample_count, 2), dtype=numpy.int8)
+    buf[:] = mono[:, numpy.newaxis]
+
+    return buf
+
+
+############## band-limited wavetables
+def harmonics(wavetype, count):
+    """Returns the sine amplitudes of the first count harmonics, matching
+    the phase of wave_sine, wave_saw and wave_square"""
+
+    k = numpy.arange(1, count + 1)
+    if wavetype == 'sine':
+        return (k == 1).astype(float)
+    if wavetype == 'saw':
+        return -2 / (numpy.pi * k)
+    if wavetype == 'square':
+        return numpy.where(k % 2 == 1, -4 / (numpy.pi * k), 0.0)
+
+    raise ValueError('unknown wavetype {}'.format(wavetype))
+
+
+_tables = {}
+
+def wavetable(wavetype, level, samplerate=SAMPLERATE):
+    """Returns one period of a wavetype, band-limited so that no harmonic of
+    the notes in octave level (counted from BASE_FREQUENCY) reaches Nyquist"""
+
+    key = (wavetype, level, samplerate)
+    table = _tables.get(key)
+    if table is None:
+        highest = BASE_FREQUENCY * 2**(level + 1)
+        count = max(1, min(int(samplerate / 2 / highest), TABLE_SIZE // 2 - 1))
+
+        # sine amplitudes are the negative imaginary part of the spectrum
+        spectrum = numpy.zeros(TABLE_SIZE // 2 + 1, dtype=complex)
+        spectrum[1:count + 1] = -0.5j * TABLE_SIZE * harmonics(wavetype, count)
+        table = numpy.fft.irfft(spectrum, TABLE_SIZE)
+
+        # the Gibbs overshoot would clip
+        table /= numpy.abs(table).max()
+        _tables[key] = table
+
+    return table
+
+
+def octave_level(frequency):
+    return max(0, int(numpy.floor(numpy.log2(frequency / BASE_FREQUENCY))))
+
+
+def loop_periods(frequency, samplerate=SAMPLERATE):
+    """Returns the number of periods and the length in samples of the
+    shortest loop that is detuned by less than MAX_DETUNE_CENTS"""
+
+    periods = numpy.arange(1, MAX_PERIODS + 1)
+    lengths = numpy.maximum(1, numpy.round(periods * samplerate / frequency))
+    cents = numpy.abs(1200 * numpy.log2(periods * samplerate / lengths / frequency))
+
+    good = numpy.flatnonzero(cents < MAX_DETUNE_CENTS)
+    index = good[0] if len(good) else numpy.argmin(cents)
+    return int(periods[index]), int(lengths[index])
+
+
+def loop_length(frequency, samplerate=SAMPLERATE):
+    return loop_periods(frequency, samplerate)[1]
+
+
+def render_wavetable(frequency, wavetype, samplerate=SAMPLERATE):
+    """Renders a seamless loop of a band-limited wavetype as a stereo int8
+    buffer, reading the wavetable with linear interpolation"""
+
+    periods, sample_count = loop_periods(frequency, samplerate)
+    table = wavetable(wavetype, octave_level(frequency), samplerate)
+
+    position = numpy.arange(sample_count) * (periods * TABLE_SIZE / sample_count)
+    index = position.astype(int)
+    fraction = position - index
+    index %= TABLE_SIZE
+    mono = table[index] + fraction * (table[(index + 1) % TABLE_SIZE] - table[index])
+
+    buf = numpy.empty((sample_count, 2), dtype=numpy.int8)
+    buf[:] = numpy.round(max_sample * mono)[:, numpy.newaxis]
+
+    return buf
+
+############## /band-limited wavetables
+
+
+def to_mixer_format(buf, channels=1):
+    """Converts a stereo int8 buffer into signed 16 bit samples with the given
+    number of channels; the upsampling is exact, so the sound doesn't change"""
+
+    wide = buf[:, 0].astype(numpy.int16) << 8
+    if channels == 1:
+        return wide
+
+    out = numpy.empty((len(wide), channels), dtype=numpy.int16)
+    out[:] = wide[:, numpy.newaxis]
+    return out
+
+
+def mixdown(buffers, gains, channels=1):
+    """Mixes stereo int8 loops of the same length into one signed 16 bit
+    buffer; every loop is scaled by its gain, a volume or a curve spanning
+    whole loops, and the sum is clipped like the mixer would"""
+
+    length = max([len(buffers[0])] + [numpy.size(gain) for gain in gains])
+    mix = numpy.zeros(length, dtype=numpy.float32)
+    for buf, gain in zip(buffers, gains):
+        mix += gain * numpy.tile(to_mixer_format(buf), length // len(buf))
+    wide = numpy.clip(numpy.round(mix), -32768, 32767).astype(numpy.int16)
+    if channels == 1:
+        return wide
+
+    out = numpy.empty((len(wide), channels), dtype=numpy.int16)
+    out[:] = wide[:, numpy.newaxis]
+    return out
+
+############## envelopes
+
+# attack, decay and release in milliseconds, sustain as a level from 0 to 1
+Envelope = collections.namedtuple('Envelope', ['attack_ms', 'decay_ms', 'sustain', 'release_ms'])
+
+# length of the sustain segment, which is queued over and over while a key is held
+SEGMENT_MS = 100
+
+
+def segment_length(ms, loop, samplerate=SAMPLERATE):
+    """Returns the whole number of loops, at least one, that lasts ms"""
+
+    return max(1, int(numpy.ceil(samplerate * ms / 1000.0 / loop))) * loop
+
+
+def render_envelope(buffers, volumes, envelopes, samplerate=SAMPLERATE, channels=1):
+    """Renders the attack+decay, sustain and release segments of the loops
+    of a key, every wave shaped by its own envelope; each segment spans
+    whole loops, so they can be queued one after another without clicks"""
+
+    loop = len(buffers[0])
+    per_ms = samplerate / 1000.0
+
+    attack_t = numpy.arange(segment_length(max(e.attack_ms + e.decay_ms for e in envelopes),
+                                           loop, samplerate))
+    release_t = numpy.arange(segment_length(max(e.release_ms for e in envelopes),
+                                            loop, samplerate))
+    sustain_length = segment_length(SEGMENT_MS, loop, samplerate)
+
+    attack, sustain, release = [], [], []
+    for volume, e in zip(volumes, envelopes):
+        attack_n = max(1.0, per_ms * e.attack_ms)
+        decay_n = max(1.0, per_ms * e.decay_ms)
+        release_n = max(1.0, per_ms * e.release_ms)
+
+        decay = 1.0 - (1.0 - e.sustain) * numpy.clip((attack_t - attack_n) / decay_n, 0.0, 1.0)
+        attack.append(volume * numpy.where(attack_t < attack_n, attack_t / attack_n, decay))
+        sustain.append(numpy.full(sustain_length, volume * e.sustain))
+        release.append(volume * e.sustain * numpy.maximum(0.0, 1.0 - release_t / release_n))
+
+    return (mixdown(buffers, attack, channels), mixdown(buffers, sustain, channels),
+            mixdown(buffers, release, channels))
+
+############## /envelopes
+
+
+def generate_bank(frequencies, wavetype, samplerate=SAMPLERATE):
+    """Renders the loops of all frequencies, stored one after another"""
+
+    return numpy.concatenate([render_wavetable(f, wavetype, samplerate)
+                              for f in frequencies])
+
+
+def split_bank(bank, frequencies, samplerate=SAMPLERATE):
+    """Splits a bank into one buffer per frequency without copying"""
+
+    buffers = []
+    offset = 0
+    for f in frequencies:
+        sample_count = loop_length(f, samplerate)
+        buffers.append(bank[offset:offset + sample_count])
+        offset += sample_count
+
+    return buffers
+
+
+def bank_key(frequencies, wavetype, samplerate=SAMPLERATE):
+    """Hashes every parameter the buffers of a bank depend on"""
+
+    parameters = (GENERATOR_VERSION, samplerate, BITRATE,
+                  TABLE_SIZE, MAX_PERIODS, MAX_DETUNE_CENTS,
+                  wavetype, [float(f) for f in frequencies])
+    return hashlib.sha1(repr(parameters).encode()).hexdigest()[:16]
+
+
+def save_bank(bank, path):
+    """Writes a bank atomically and removes outdated banks of the same wavetype"""
+
+    directory, filename = os.path.split(path)
+    prefix = filename.split('-')[0] + '-'
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        numpy.save(f, bank)
+    os.replace(tmp_path, path)
+
+    for old in os.listdir(directory):
+        if old.startswith(prefix) and old != filename:
+            os.remove(os.path.join(directory, old))
+
+
+def load_bank(frequencies, wavetype, cache_dir=CACHE_DIR, samplerate=SAMPLERATE):
+    """Returns one buffer per frequency, memory-mapped from the cache if the
+    bank was generated with the same parameters before"""
+
+    path = os.path.join(cache_dir, '{}-{}.npy'.format(wavetype,
+                                                     bank_key(frequencies, wavetype, samplerate)))
+
+    try:
+        bank = numpy.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        bank = generate_bank(frequencies, wavetype, samplerate)
+        try:
+            save_bank(bank, path)
+        except OSError:
+            pass  # read-only installation, regenerate on every start
+
+    return split_bank(bank, frequencies, samplerate)
+
+
+class LazyBank:
+    """ Builds the sound of a combination of wavetypes and a key on first
+    use instead of generating every bank up front. make_sound turns the
+    buffers of the combination, one per wavetype, into a single playable
+    sound and gets the wavetype names for balancing the volumes. The least
+    recently used sounds are dropped beyond max_bytes, as measured by
+    sound_bytes. The banks of the wavetypes are loaded on the executor, if
+    one is given. """
+
+    def __init__(self, make_sound, frequencies=FREQUENCIES, cache_dir=CACHE_DIR,
+                 samplerate=SAMPLERATE, max_bytes=MAX_BYTES, sound_bytes=None,
+                 executor=None):
+        self.make_sound = make_sound
+        self.frequencies = frequencies
+        self.cache_dir = cache_dir
+        self.samplerate = samplerate
+        self.max_bytes = max_bytes
+        self.sound_bytes = sound_bytes
+        self.executor = executor
+
+        # wavetype -> future of its buffers
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        # wavetype -> seconds its bank took to load or generate
+        self.timings = {}
+        # (combination, key) -> (sound, bytes), oldest first
+        self.sounds = collections.OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+        self.prewarm_thread = None
+        self.prewarm_stop = threading.Event()
+
+    def get(self, combination, key, create=True):
+        """Returns the sound of a key for a tuple of wavetypes, None if it was
+        not built yet and create is False"""
+
+        entry = self.sounds.get((combination, key))
+        if entry is not None:
+            # without the lock, which a build holds; evict may have
+            # dropped the sound meanwhile
+            try:
+                self.sounds.move_to_end((combination, key))
+            except KeyError:
+                pass
+            return entry[0]
+        if not create:
+            return None
+
+        with self.lock:
+            entry = self.sounds.get((combination, key))
+            if entry is None:
+                buffers = [self.bank(wavetype)[key] for wavetype in combination]
+                sound = self.make_sound(buffers, combination)
+                size = self.sound_bytes(sound) if self.sound_bytes else buffers[0].nbytes
+
+                entry = self.sounds[(combination, key)] = (sound, size)
+                self.used_bytes += size
+                self.evict()
+            else:
+                self.sounds.move_to_end((combination, key))
+
+        return entry[0]
+
+    def bank(self, wavetype):
+        self.load_banks([wavetype])
+        return self.buffers[wavetype].result()
+
+    def load_banks(self, wavetypes):
+        """Starts loading the banks of wavetypes on the executor, without
+        waiting for them"""
+
+        with self.buffers_lock:
+            for wavetype in wavetypes:
+                if wavetype in self.buffers:
+                    continue
+                if self.executor is None:
+                    self.buffers[wavetype] = concurrent.futures.Future()
+                    self.buffers[wavetype].set_result(self._load_bank(wavetype))
+                else:
+                    self.buffers[wavetype] = self.executor.submit(self._load_bank, wavetype)
+
+    def _load_bank(self, wavetype):
+        start = time.perf_counter()
+        buffers = load_bank(self.frequencies, wavetype, self.cache_dir, self.samplerate)
+        self.timings[wavetype] = time.perf_counter() - start
+        return buffers
+
+    def evict(self):
+        while self.used_bytes > self.max_bytes and len(self.sounds) > 1:
+            _, (_, size) = self.sounds.popitem(last=False)
+            self.used_bytes -= size
+
+    def memory(self):
+        """Reports how many sounds are built and the memory they take"""
+
+        return {'sounds': len(self.sounds), 'bytes': self.used_bytes,
+                'max_bytes': self.max_bytes}
+
+    def prewarm(self, combination, keys=None):
+        """Builds the sounds of a combination for keys (default: all) in a
+        background thread, until the memory limit is reached; replaces a
+        prewarm that is still running"""
+
+        self.stop_prewarm()
+
+        if keys is None:
+            keys = range(len(self.frequencies))
+
+        self.prewarm_stop.clear()
+        self.prewarm_thread = threading.Thread(target=self._prewarm,
+                                               args=(combination, list(keys)),
+                                               daemon=True)
+        self.prewarm_thread.start()
+
+    def stop_prewarm(self):
+        if self.prewarm_thread is not None:
+            self.prewarm_stop.set()
+            self.prewarm_thread.join()
+            self.prewarm_thread = None
+
+    def _prewarm(self, combination, keys):
+        for key in keys:
+            if self.prewarm_stop.is_set() or self.used_bytes >= self.max_bytes:
+                return
+            self.get(combination, key)
@@ -0,0 +1,151 @@
+""" Voice allocation on top of pygame.mixer.Channel: every instrument gets
+its own budget of channels, so a drum roll can't take the channels of a
+held synth chord and the other way round. """
+
+import itertools
+import threading
+import time
+
+import pygame
+
+# a stolen voice is faded out this long before the new sound starts
+STEAL_FADE_MS = 10
+
+
+class VoicePool:
+    """ A fixed range of mixer channels and when each one was started. """
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.started = [0.0] * len(channels)
+        self.lengths = [0.0] * len(channels)
+        # until when a stolen channel is fading out
+        self.fading = [0.0] * len(channels)
+        # a token for each looped sound waiting for the fade of a stolen
+        # channel, only the start holding the current token plays
+        self.pending = [None] * len(channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+
+class VoiceAllocator:
+    """ Splits the mixer channels into one pool per instrument, in the order
+    of budgets. When a pool is full, the oldest voice ('oldest') or the one
+    closest to its end ('quietest', samples decay towards their end) is
+    faded out and replaced. """
+
+    def __init__(self, budgets, policy='quietest'):
+        if sum(budgets.values()) > pygame.mixer.get_num_channels():
+            raise ValueError('budgets exceed the {} mixer channels'.format(
+                pygame.mixer.get_num_channels()))
+
+        self.policy = policy
+        self.pools = {}
+        first = 0
+        for name, budget in budgets.items():
+            self.pools[name] = VoicePool([pygame.mixer.Channel(i)
+                                          for i in range(first, first + budget)])
+            first += budget
+
+        # keep pygame's own Sound.play away from the allocated channels
+        pygame.mixer.set_reserved(first)
+
+        self.counters = {'played': 0, 'stolen': 0, 'dropped': 0}
+        self.lock = threading.Lock()
+        self.tokens = itertools.count()
+
+        # replaces a queued sound that mustn't start after a fade
+        self.silence = pygame.mixer.Sound(buffer=bytes(2 * pygame.mixer.get_init()[2]))
+
+    def play(self, pool_name, sound, loops=0, fade_ms=0):
+        """Plays sound on a channel of the pool and returns the channel,
+        None if the voice was dropped"""
+
+        pool = self.pools[pool_name]
+        now = time.monotonic()
+
+        with self.lock:
+            index = self.find_free(pool)
+            stolen = index is None
+            if stolen:
+                index = self.find_victim(pool, now)
+                if index is None:
+                    self.counters['dropped'] += 1
+                    return None
+                pool.fading[index] = now + STEAL_FADE_MS / 1000.0
+                token = next(self.tokens) if loops != 0 else None
+                pool.pending[index] = token
+                self.counters['stolen'] += 1
+
+            pool.started[index] = now
+            pool.lengths[index] = float('inf') if loops < 0 else sound.get_length() * (loops + 1)
+            self.counters['played'] += 1
+
+        channel = pool.channels[index]
+        if stolen:
+            # the new sound starts as soon as the fade has silenced the channel
+            channel.fadeout(STEAL_FADE_MS)
+            if loops == 0:
+                channel.queue(sound)
+            else:
+                # queued sounds can't loop, they are started after the fade
+                threading.Timer(STEAL_FADE_MS / 1000.0, self.start_pending,
+                                (pool, index, token, sound, loops, fade_ms)).start()
+        else:
+            channel.play(sound, loops=loops, fade_ms=fade_ms)
+
+        return channel
+
+    def start_pending(self, pool, index, token, sound, loops, fade_ms):
+        """Starts a looped sound on the stolen channel it waited for, unless
+        the channel was stolen again meanwhile, even for the same sound"""
+
+        with self.lock:
+            if pool.pending[index] != token:
+                return
+            pool.pending[index] = None
+
+        pool.channels[index].play(sound, loops=loops, fade_ms=fade_ms)
+
+    def crossfade(self, channel, pool_name, sound, ms, loop=0):
+        """Fades channel out and sound in on another channel of the pool
+        over ms, returns that channel; pygame can't start a sound within
+        its loop, so loop is ignored"""
+
+        pool = self.pools[pool_name]
+        with self.lock:
+            pool.fading[pool.channels.index(channel)] = time.monotonic() + ms / 1000.0
+
+        channel.queue(self.silence)
+        channel.fadeout(ms)
+        return self.play(pool_name, sound, fade_ms=ms)
+
+    def active_voices(self):
+        return {name: sum(channel.get_busy() for channel in pool.channels)
+                for name, pool in self.pools.items()}
+
+    def stop_all(self):
+        for pool in self.pools.values():
+            pool.pending = [None] * len(pool)
+            for channel in pool.channels:
+                channel.stop()
+
+    def find_free(self, pool):
+        for index, channel in enumerate(pool.channels):
+            # a channel whose looped sound waits for the fade isn't free
+            if pool.pending[index] is None and not channel.get_busy():
+                return index
+        return None
+
+    def find_victim(self, pool, now):
+        # voices that are being stolen already are fading out
+        candidates = [i for i in range(len(pool)) if pool.fading[i] <= now]
+        if not candidates:
+            return None
+
+        if self.policy == 'oldest':
+            return min(candidates, key=lambda i: pool.started[i])
+
+        # the least remaining playing time is the quietest, decayed voice
+        return min(candidates, key=lambda i: pool.lengths[i] - (now - pool.started[i]))